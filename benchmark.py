@@ -0,0 +1,668 @@
+import argparse
+import time
+import torch
+from torch.profiler import profile, ProfilerActivity
+from ogb.nodeproppred import Evaluator
+from torch_geometric.data import Data
+from torch_geometric.loader import NeighborLoader
+from torch_scatter import scatter
+from torch_geometric.utils import softmax
+from data import to_csr, quantise_edge_attr, pack_labels, unpack_labels
+from models.mlp import MLP
+from models.gnn import GNN
+from models.transformers import AttentionGNN, BucketedAttention, EdgeProjectionCache, FeatureAttentionLayer, LabelInjectionAttentionLayer, LabelEmbeddingAttentionLayer, LinearAttentionLayer
+from sampler import NeighbourSampler, NeighbourTableLoader, full_neighbour_batch
+from training import bf16_supported
+
+'''
+CPU benchmarks of the data pipeline and models on a synthetic graph shaped like ogbn-proteins (8 edge features in [0, 1],
+112 binary labels), run e.g. `python benchmark.py edge_quant --nodes 20000 --degree 100`
+'''
+
+
+def synthetic_graph(num_nodes=20000, avg_degree=100, seed=0):
+	'''
+	create a random undirected graph with ogbn-proteins shaped features
+	params:
+		- num_nodes: number of nodes in the graph
+		- avg_degree: average number of incoming edges per node
+		- seed: random seed
+	returns:
+		graph and dictionary of split (train | valid | test) indexes
+	'''
+	generator = torch.Generator().manual_seed(seed)
+	num_edges = num_nodes * avg_degree // 2
+
+	src = torch.randint(0, num_nodes, (num_edges,), generator=generator)
+	dst = torch.randint(0, num_nodes, (num_edges,), generator=generator)
+	edge_index = torch.stack([torch.cat([src, dst]), torch.cat([dst, src])])
+	edge_attr = torch.rand(edge_index.size(1), 8, generator=generator)
+
+	# labels correlated with the mean edge feature of each node so that ROC is meaningful
+	x = scatter(edge_attr, edge_index[0], dim=0, dim_size=num_nodes, reduce='mean')
+	y = (x @ torch.randn(8, 112, generator=generator) + 0.1 * torch.randn(num_nodes, 112, generator=generator)).gt(0).long()
+
+	perm = torch.randperm(num_nodes, generator=generator)
+	split_idx = {
+		'train': perm[:num_nodes // 2],
+		'valid': perm[num_nodes // 2:3 * num_nodes // 4],
+		'test': perm[3 * num_nodes // 4:],
+	}
+
+	graph = Data(edge_index=edge_index, edge_attr=edge_attr, y=y, num_nodes=num_nodes,
+					node_species=torch.randint(0, 8, (num_nodes, 1), generator=generator))
+	return graph, split_idx
+
+
+def time_fn(fn, repeats=5):
+	'''
+	returns:
+		mean wall time of fn in seconds over repeats calls, after one warm up call
+	'''
+	fn()
+	start = time.perf_counter()
+	for _ in range(repeats):
+		fn()
+	return (time.perf_counter() - start) / repeats
+
+
+def peak_memory(fn):
+	'''
+	returns:
+		peak CPU memory allocated by tensors during a call of fn in MB, from the allocations recorded by the profiler
+	'''
+	with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+		fn()
+
+	current, peak = 0, 0
+	for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+		# allocations are recorded against the op that made them, frees outside of an op as [memory] events
+		current += event.cpu_memory_usage if event.name == '[memory]' else event.self_cpu_memory_usage
+		peak = max(peak, current)
+	return peak / 2**20
+
+
+def prepare_graph(graph):
+	# node features and observed labels as GraphTrainer computes them
+	graph.x = scatter(graph.edge_attr, graph.edge_index[0], dim=0, dim_size=graph.num_nodes, reduce='mean')
+	graph.train_masked_y = graph.y.float()
+	graph.eval_masked_y = graph.y.float()
+	return graph
+
+
+def bench_edge_quant(graph, split_idx, batch_size=32, repeats=5):
+	'''
+	compare float32, float16 and uint8 edge feature storage: memory, collation throughput and model output deviation
+	relative to the largest float32 output
+	'''
+	graph = prepare_graph(graph)
+	csr = to_csr(graph.edge_index, graph.num_nodes)
+	model = AttentionGNN(in_dim=8, hid_dim=64, out_dim=112).eval()
+
+	generator = torch.Generator().manual_seed(0)
+	seeds = split_idx['train'][torch.randperm(split_idx['train'].numel(), generator=generator)[:batch_size]]
+	batch = full_neighbour_batch(graph, csr, seeds)
+	e_id = torch.randint(0, graph.edge_attr.size(0), (batch_size * 100 * 10,), generator=generator)
+
+	with torch.no_grad():
+		reference = model(batch.clone())
+
+		print('{0:<10}{1:>12}{2:>18}{3:>16}{4:>16}'.format('dtype', 'MB', 'gather (M e/s)', 'max abs err', 'rel out diff'))
+		for dtype in [torch.float32, torch.float16, torch.uint8]:
+			edge_attr = graph.edge_attr if dtype == torch.float32 else quantise_edge_attr(graph.edge_attr, dtype)
+			gather_time = time_fn(lambda: edge_attr[e_id], repeats=repeats)
+
+			quant_batch = batch.clone()
+			quant_batch.edge_attr = edge_attr[batch.e_id]
+			out = model(quant_batch)
+
+			dequant = edge_attr.float() / 255. if dtype == torch.uint8 else edge_attr.float()
+			print('{0:<10}{1:>12.1f}{2:>18.1f}{3:>16.2e}{4:>16.2e}'.format(
+				str(dtype).replace('torch.', ''),
+				edge_attr.numel() * edge_attr.element_size() / 2**20,
+				e_id.numel() / gather_time / 1e6,
+				(dequant - graph.edge_attr).abs().max().item(),
+				((out - reference).abs().max() / reference.abs().max()).item(),
+			))
+
+
+def bench_sampler(graph, split_idx, batch_size=32, fanout=100, num_batches=200):
+	'''
+	compare batches per second of the one-hop samplers GraphTrainer can use
+	'''
+	graph = prepare_graph(graph)
+	csr = to_csr(graph.edge_index, graph.num_nodes)
+	input_nodes = split_idx['train']
+
+	loaders = {
+		'NeighborLoader': lambda: NeighborLoader(graph, num_neighbors=[fanout], batch_size=batch_size, directed=True,
+										replace=True, shuffle=True, input_nodes=input_nodes),
+		'NeighbourSampler': lambda: NeighbourSampler(graph, csr, input_nodes, fanout, batch_size, shuffle=True),
+		'NeighbourTableLoader': lambda: NeighbourTableLoader(graph, csr, input_nodes, fanout, batch_size, shuffle=True, refresh=0),
+	}
+
+	print('{0:<24}{1:>14}'.format('sampler', 'batches/s'))
+	for name, make_loader in loaders.items():
+		try:
+			loader = make_loader()
+			iterator = iter(loader)
+			next(iterator)
+		except ImportError:
+			print('{0:<24}{1:>14}'.format(name, 'unavailable'))
+			continue
+
+		count = 0
+		start = time.perf_counter()
+		for _ in range(num_batches):
+			try:
+				next(iterator)
+			except StopIteration:
+				iterator = iter(loader)
+				next(iterator)
+			count += 1
+		print('{0:<24}{1:>14.1f}'.format(name, count / (time.perf_counter() - start)))
+
+
+def bench_labels(graph, split_idx, batch_size=32, fanout=100, repeats=20):
+	'''
+	compare dense label tensors (y, train_masked_y and eval_masked_y) with bit-packed labels: memory and time to collate
+	the labels of one sampled batch, checking that unpacking reproduces the dense labels
+	'''
+	graph = prepare_graph(graph)
+	generator = torch.Generator().manual_seed(0)
+
+	train_observed = torch.zeros(graph.num_nodes, dtype=torch.bool)
+	train_observed[split_idx['train']] = torch.rand(split_idx['train'].numel(), generator=generator).ge(0.5)
+	eval_observed = torch.zeros(graph.num_nodes, dtype=torch.bool)
+	eval_observed[split_idx['train']] = True
+	graph.train_masked_y = graph.y * train_observed.unsqueeze(-1).float()
+	graph.eval_masked_y = graph.y * eval_observed.unsqueeze(-1).float()
+	y_packed, label_flags = pack_labels(graph.y, train_observed, eval_observed)
+
+	n_id = torch.randint(0, graph.num_nodes, (batch_size * (fanout + 1),), generator=generator)
+	dense_keys = ['y', 'train_masked_y', 'eval_masked_y']
+
+	def collate_dense():
+		return Data(**{key: graph[key][n_id] for key in dense_keys})
+
+	def collate_packed():
+		return unpack_labels(Data(y_packed=y_packed[n_id], label_flags=label_flags[n_id]))
+
+	dense, packed = collate_dense(), collate_packed()
+	match = all(torch.equal(dense[key], packed[key]) for key in dense_keys)
+
+	print('{0:<10}{1:>12}{2:>16}{3:>18}'.format('labels', 'MB', 'B per node', 'collate (ms)'))
+	for name, tensors, fn in [('dense', [graph[key] for key in dense_keys], collate_dense), ('packed', [y_packed, label_flags], collate_packed)]:
+		num_bytes = sum(t.numel() * t.element_size() for t in tensors)
+		print('{0:<10}{1:>12.1f}{2:>16.1f}{3:>18.3f}'.format(name, num_bytes / 2**20, num_bytes / graph.num_nodes, time_fn(fn, repeats=repeats) * 1e3))
+	print('unpacked labels match: {0}'.format(match))
+
+
+def check_edge_scoring(layer, x, batch, tolerance=1e-5):
+	'''
+	check the attention scores of a layer, q_i . k_j plus EdgeLinear.score in both edge_space modes, against the original
+	per-edge formula (q_i * (e_ij + k_j)).sum(-1) with e_ij = W a_ij + b, for float32, float16 and uint8 edge features
+	params:
+		- tolerance: largest allowed difference relative to the largest original score
+	returns:
+		largest relative difference, raises an Exception if it is above tolerance
+	'''
+	H, C = layer.heads, layer.out_dim
+	src, index = batch.edge_index
+	worst = 0.
+	with torch.no_grad():
+		q = layer.lin_query(x).view(-1, H, C)
+		k = layer.lin_key_node(x).view(-1, H, C)
+		for dtype in [torch.float32, torch.float16, torch.uint8]:
+			edge_attr = batch.edge_attr if dtype == torch.float32 else quantise_edge_attr(batch.edge_attr, dtype)
+			# uint8 features hold 255 quantisation steps of [0, 1]
+			a = edge_attr.float() / 255. if dtype == torch.uint8 else edge_attr.float()
+			e = torch.nn.functional.linear(a, layer.lin_key_edge.weight, layer.lin_key_edge.bias).view(-1, H, C)
+			original = (q[index] * (e + k[src])).sum(dim=-1)
+
+			for edge_space in [True, False]:
+				score = layer.lin_key_edge.score(q, edge_attr, index, edge_space) + (q[index] * k[src]).sum(dim=-1)
+				diff = ((score - original).abs().max() / original.abs().max()).item()
+				if diff > tolerance:
+					raise Exception('check_edge_scoring(): {0} scores with {1} edge features and edge_space={2} differ from the original formula by {3:.2e}'.format(
+						type(layer).__name__, dtype, edge_space, diff))
+				worst = max(worst, diff)
+	return worst
+
+
+def bench_edge_scoring(graph, split_idx, batch_size=64, hid_dim=64, repeats=5):
+	'''
+	compare scoring edges in the edge feature space (queries projected to edge_dim once per node) with projecting every
+	edge to heads * out_dim, for each attention layer: output parity, training step throughput and peak memory. The
+	scores of both are first checked against the original per-edge formula, see check_edge_scoring
+	'''
+	graph = prepare_graph(graph)
+	csr = to_csr(graph.edge_index, graph.num_nodes)
+	batch = full_neighbour_batch(graph, csr, split_idx['train'][:batch_size])
+	batch.x = torch.randn(batch.num_nodes, hid_dim)
+	num_edges = batch.edge_index.size(1)
+
+	print('{0} edges'.format(num_edges))
+	for layer_type in [FeatureAttentionLayer, LabelInjectionAttentionLayer, LabelEmbeddingAttentionLayer]:
+		for heads in [1, 4]:
+			diff = check_edge_scoring(layer_type(hid_dim, hid_dim // heads, attn_heads=heads), batch.x, batch)
+			print('{0} scores match the original formula with {1} heads (max rel diff {2:.2e})'.format(layer_type.__name__, heads, diff))
+
+	print('{0:<32}{1:<8}{2:>14}{3:>12}{4:>16}'.format('layer', 'scoring', 'M edges/s', 'peak MB', 'rel out diff'))
+	for layer_type in [FeatureAttentionLayer, LabelInjectionAttentionLayer, LabelEmbeddingAttentionLayer]:
+		layer = layer_type(hid_dim, hid_dim, dropout=0.)
+
+		def step():
+			layer(batch.x, batch).sum().backward()
+
+		with torch.no_grad():
+			layer.edge_space = False
+			reference = layer(batch.x, batch)
+
+		for edge_space in [False, True]:
+			layer.edge_space = edge_space
+			with torch.no_grad():
+				out = layer(batch.x, batch)
+
+			print('{0:<32}{1:<8}{2:>14.2f}{3:>12.1f}{4:>16.2e}'.format(
+				layer_type.__name__,
+				'edge' if edge_space else 'dense',
+				num_edges / time_fn(step, repeats=repeats) / 1e6,
+				peak_memory(step),
+				((out - reference).abs().max() / reference.abs().max()).item(),
+			))
+
+
+def bench_edge_cache(graph, split_idx, batch_size=32, fanout=100, hid_dim=64):
+	'''
+	evaluation passes over a fixed set of sampled batches with per-edge projections (edge_space off), without and with an
+	EdgeProjectionCache, under bfloat16 autocast (cached separately) and after a parameter update which invalidates the
+	cache. Edge feature space scoring, which does not project edges at all, is shown for reference
+	'''
+	graph = prepare_graph(graph)
+	csr = to_csr(graph.edge_index, graph.num_nodes)
+	loader = NeighbourTableLoader(graph, csr, split_idx['valid'], fanout, batch_size, shuffle=False, refresh=0)
+	model = AttentionGNN(in_dim=8, hid_dim=hid_dim, out_dim=112).eval()
+	cache = EdgeProjectionCache()
+
+	def evaluate():
+		with torch.no_grad():
+			return torch.cat([model(batch.clone())[:batch.batch_size] for batch in loader])
+
+	def timed_pass(name):
+		start = time.perf_counter()
+		out = evaluate()
+		stats = cache.stats()
+		print('{0:<28}{1:>10.3f}{2:>8}{3:>8}{4:>12.1f}'.format(name, time.perf_counter() - start, stats['hits'], stats['misses'], stats['bytes'] / 2**20))
+		return out
+
+	print('{0:<28}{1:>10}{2:>8}{3:>8}{4:>12}'.format('pass', 'seconds', 'hits', 'misses', 'cache MB'))
+	evaluate()
+	timed_pass('edge space scoring')
+
+	for layer in model.layers:
+		layer.edge_space = False
+	reference = timed_pass('per edge, no cache')
+
+	model.set_edge_cache(cache)
+	timed_pass('per edge, cold cache')
+	cached = timed_pass('per edge, warm cache')
+	with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+		timed_pass('per edge, bfloat16 autocast')
+	after_bf16 = timed_pass('per edge, float32 again')
+
+	with torch.no_grad():
+		model.layers[0].lin_key_edge.weight.add_(1e-3)
+	updated = timed_pass('per edge, after update')
+	model.set_edge_cache(None)
+	with torch.no_grad():
+		model.layers[0].lin_key_edge.weight.sub_(1e-3)
+
+	print('warm cache matches: {0}, float32 unaffected by autocast: {1}, update invalidates: {2}'.format(
+		torch.equal(cached, reference), torch.equal(after_bf16, reference), not torch.equal(updated, reference)))
+
+
+def observed_label_graph(graph, split_idx):
+	# node features, and labels observed for train nodes only, half of them during training
+	graph = prepare_graph(graph)
+	observed = torch.zeros(graph.num_nodes, 1)
+	observed[split_idx['train']] = 1
+	graph.eval_masked_y = observed * graph.y
+	observed[split_idx['train'][torch.rand(split_idx['train'].numel()) < 0.5]] = 0
+	graph.train_masked_y = observed * graph.y
+	return graph
+
+
+def train_and_evaluate(model, train_loader, valid_loader, epochs=3, lr=1e-3, mixed_precision=False):
+	'''
+	train a model for a few epochs as GraphTrainer does and evaluate it
+	params:
+		- mixed_precision: run the model under bfloat16 autocast, the loss and ROC are computed in float32
+	returns:
+		training throughput in M edges/s and valid ROC-AUC
+	'''
+	optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+	criterion = torch.nn.BCEWithLogitsLoss()
+
+	num_edges, train_time = 0, 0
+	for _ in range(epochs):
+		model.train()
+		for batch in train_loader:
+			start = time.perf_counter()
+			optimizer.zero_grad()
+			with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=mixed_precision):
+				pred_y = model(batch)[:batch.batch_size]
+			loss = criterion(pred_y.float(), batch.y[:batch.batch_size].float())
+			loss.backward()
+			optimizer.step()
+			train_time += time.perf_counter() - start
+			num_edges += batch.edge_index.size(1)
+
+	model.eval()
+	y_true, y_pred = [], []
+	with torch.no_grad():
+		for batch in valid_loader:
+			with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=mixed_precision):
+				y_pred.append(model(batch)[:batch.batch_size].float())
+			y_true.append(batch.y[:batch.batch_size])
+
+	roc = Evaluator(name='ogbn-proteins').eval({'y_true': torch.cat(y_true), 'y_pred': torch.cat(y_pred)})['rocauc']
+	return num_edges / train_time / 1e6, roc
+
+
+def attention_label_graph(graph, split_idx, beta=5., seed=0):
+	'''
+	relabel a synthetic graph with targets that can only be learnt by attending over neighbours. Nodes get random
+	features z. Label group d (14 labels per edge feature) is a random linear function of the features of a node's
+	neighbours, averaged with softmax(beta * edge feature d) weights, thresholded at its median. Every group needs its own
+	attention pattern, which separate heads can learn. Only train labels are observed, half of them during training
+	'''
+	generator = torch.Generator().manual_seed(seed)
+	src, dst = graph.edge_index
+	edge_dim = graph.edge_attr.size(-1)
+	z = torch.randn(graph.num_nodes, 8, generator=generator)
+
+	y = []
+	for d in range(edge_dim):
+		weight = softmax(beta * graph.edge_attr[:, d], dst, num_nodes=graph.num_nodes)
+		h = scatter(weight.unsqueeze(-1) * z[src], dst, dim=0, dim_size=graph.num_nodes, reduce='sum')
+		y.append(h @ torch.randn(8, graph.y.size(-1) // edge_dim, generator=generator))
+	y = torch.cat(y, dim=-1)
+	graph.y = y.gt(y.median(dim=0)[0]).long()
+
+	graph = observed_label_graph(graph, split_idx)
+	graph.x = z
+	return graph
+
+
+def bench_heads(graph, split_idx, batch_size=32, fanout=100, hid_dim=64, epochs=10, lr=5e-3, heads=(1, 2, 4, 8)):
+	'''
+	train feature attention AttentionGNNs with 1, 2, 4 and 8 concatenated heads at a fixed hidden size, so the parameter
+	budget stays (almost) the same and only the split into heads changes: parameters, training throughput and valid
+	ROC-AUC on the labels of attention_label_graph. Messages of the label embedding layers carry neighbour labels only,
+	so the default attention type cannot learn these targets
+	'''
+	graph = attention_label_graph(graph, split_idx)
+	csr = to_csr(graph.edge_index, graph.num_nodes)
+	train_loader = NeighbourSampler(graph, csr, split_idx['train'], fanout, batch_size)
+	valid_loader = NeighbourTableLoader(graph, csr, split_idx['valid'], fanout, batch_size * 4, shuffle=False, refresh=0)
+
+	print('{0:<8}{1:>10}{2:>14}{3:>12}'.format('heads', 'params', 'M edges/s', 'valid ROC'))
+	for num_heads in heads:
+		torch.manual_seed(0)
+		model = AttentionGNN(attention_type='feature', in_dim=8, hid_dim=hid_dim, out_dim=112, attn_heads=num_heads, head_merge='concat')
+		throughput, roc = train_and_evaluate(model, train_loader, valid_loader, epochs=epochs, lr=lr)
+
+		print('{0:<8}{1:>10}{2:>14.3f}{3:>12.4f}'.format(num_heads, sum(p.numel() for p in model.parameters()), throughput, roc))
+
+
+def bench_mixed_precision(graph, split_idx, batch_size=32, fanout=100, epochs=3, lr=1e-3):
+	'''
+	train each model family in float32 and under bfloat16 autocast from the same initialisation: training throughput,
+	speedup and the change in valid ROC-AUC. Only meaningful on CPUs with bfloat16 support (AVX512-BF16 or AMX)
+	'''
+	if not bf16_supported('cpu'):
+		print('bfloat16 is not supported on this CPU, mixed precision training would fall back to float32')
+		return
+
+	graph = observed_label_graph(graph, split_idx)
+	csr = to_csr(graph.edge_index, graph.num_nodes)
+	train_loader = NeighbourSampler(graph, csr, split_idx['train'], fanout, batch_size)
+	valid_loader = NeighbourTableLoader(graph, csr, split_idx['valid'], fanout, batch_size * 4, shuffle=False, refresh=0)
+
+	models = {
+		'MLP': lambda: MLP(8, 64, 112, num_layers=3),
+		'GNN_GCN': lambda: GNN('GCN'),
+		'GNN_SAGE': lambda: GNN('SAGE'),
+		'GNN_GAT': lambda: GNN('GAT'),
+		'ATTN_self': lambda: AttentionGNN(attention_type='self'),
+		'ATTN_feature': lambda: AttentionGNN(attention_type='feature'),
+		'ATTN_linear': lambda: AttentionGNN(attention_type='linear'),
+	}
+
+	print('{0:<14}{1:>14}{2:>14}{3:>10}{4:>12}{5:>12}'.format('model', 'fp32 M e/s', 'bf16 M e/s', 'speedup', 'fp32 ROC', 'ROC delta'))
+	for name, create in models.items():
+		results = []
+		for mixed_precision in [False, True]:
+			torch.manual_seed(0)
+			results.append(train_and_evaluate(create(), train_loader, valid_loader, epochs=epochs, lr=lr, mixed_precision=mixed_precision))
+		(fp32, fp32_roc), (bf16, bf16_roc) = results
+
+		print('{0:<14}{1:>14.3f}{2:>14.3f}{3:>10.2f}{4:>12.4f}{5:>12.4f}'.format(name, fp32, bf16, bf16 / fp32, fp32_roc, bf16_roc - fp32_roc))
+
+
+def bench_bucketed_attention(graph, split_idx, batch_size=256, hid_dim=64, heads=(1, 4), repeats=5):
+	'''
+	neighbourhood attention of FeatureAttentionLayer over full one-hop batches with the scatter softmax of propagate and
+	with BucketedAttention, mixed (narrow buckets scattered) and fully dense: training step and inference throughput,
+	and output parity with propagate
+	'''
+	graph = prepare_graph(graph)
+	csr = to_csr(graph.edge_index, graph.num_nodes)
+	batch = full_neighbour_batch(graph, csr, split_idx['train'][:batch_size])
+	batch.x = torch.randn(batch.num_nodes, hid_dim)
+	num_edges = batch.edge_index.size(1)
+	deg = torch.bincount(batch.edge_index[1])[:batch_size]
+
+	print('{0} edges, target degree {1} to {2}'.format(num_edges, deg.min().item(), deg.max().item()))
+	print('{0:<8}{1:<12}{2:>8}{3:>16}{4:>16}{5:>16}'.format('heads', 'engine', 'blocks', 'train M edges/s', 'eval M edges/s', 'rel out diff'))
+	for num_heads in heads:
+		layer = FeatureAttentionLayer(hid_dim, hid_dim // num_heads, attn_heads=num_heads, dropout=0.)
+
+		def step():
+			layer(batch.x, batch).sum().backward()
+
+		def evaluate():
+			with torch.no_grad():
+				return layer(batch.x, batch)
+
+		layer.engine = None
+		reference = evaluate()
+
+		for name, engine in [('scatter', None), ('mixed', BucketedAttention(min_degree=16)), ('dense', BucketedAttention(min_degree=0))]:
+			layer.engine = engine
+			out = evaluate()
+
+			print('{0:<8}{1:<12}{2:>8}{3:>16.2f}{4:>16.2f}{5:>16.2e}'.format(
+				num_heads,
+				name,
+				len(engine.last_plan[0]) if engine is not None else 0,
+				num_edges / time_fn(step, repeats=repeats) / 1e6,
+				num_edges / time_fn(evaluate, repeats=repeats) / 1e6,
+				((out - reference).abs().max() / reference.abs().max()).item(),
+			))
+
+
+def bench_linear_attention(graph, split_idx, batch_size=32, hid_dim=64, fanouts=(100, 200, 400, 600), repeats=5):
+	'''
+	softmax neighbourhood attention (FeatureAttentionLayer) against kernelised attention (LinearAttentionLayer) on
+	NeighbourSampler batches at increasing fanouts: training step and inference throughput, and peak memory of a step
+	'''
+	graph = prepare_graph(graph)
+	csr = to_csr(graph.edge_index, graph.num_nodes)
+
+	print('{0:<8}{1:<12}{2:>16}{3:>16}{4:>12}'.format('fanout', 'attention', 'train M edges/s', 'eval M edges/s', 'peak MB'))
+	for fanout in fanouts:
+		loader = NeighbourSampler(graph, csr, split_idx['train'], fanout, batch_size)
+		batch = next(iter(loader)).clone()
+		batch.x = torch.randn(batch.num_nodes, hid_dim)
+		num_edges = batch.edge_index.size(1)
+
+		for name, layer_type in [('softmax', FeatureAttentionLayer), ('linear', LinearAttentionLayer)]:
+			layer = layer_type(hid_dim, hid_dim)
+
+			def step():
+				layer.train()
+				layer(batch.x, batch).sum().backward()
+
+			def evaluate():
+				layer.eval()
+				with torch.no_grad():
+					layer(batch.x, batch)
+
+			print('{0:<8}{1:<12}{2:>16.2f}{3:>16.2f}{4:>12.1f}'.format(
+				fanout,
+				name,
+				num_edges / time_fn(step, repeats=repeats) / 1e6,
+				num_edges / time_fn(evaluate, repeats=repeats) / 1e6,
+				peak_memory(step),
+			))
+
+
+def bench_compile(graph, split_idx, batch_size=32, fanout=100, repeats=10):
+	'''
+	torch.compile of each model family on NeighbourSampler batches (fixed shapes): number of compiled graphs (1 means no
+	graph breaks), time of the first compiled training step, and steady state training step time eager and compiled
+	'''
+	graph = prepare_graph(graph)
+	csr = to_csr(graph.edge_index, graph.num_nodes)
+	loader = NeighbourSampler(graph, csr, split_idx['train'], fanout, batch_size)
+	batches = [batch.clone() for batch, _ in zip(loader, range(repeats + 1))]
+
+	models = {
+		'MLP': lambda: MLP(8, 64, 112, num_layers=3),
+		'GNN_GCN': lambda: GNN('GCN'),
+		'GNN_SAGE': lambda: GNN('SAGE'),
+		'GNN_GAT': lambda: GNN('GAT'),
+		'ATTN_self': lambda: AttentionGNN(attention_type='self'),
+		'ATTN_feature': lambda: AttentionGNN(attention_type='feature'),
+		'ATTN_linear': lambda: AttentionGNN(attention_type='linear'),
+	}
+
+	print('{0:<14}{1:>8}{2:>12}{3:>12}{4:>14}{5:>16}'.format('model', 'graphs', 'compile s', 'eager ms', 'compiled ms', 'rel out diff'))
+	for name, create in models.items():
+		torch.manual_seed(0)
+		model = create()
+
+		def step(batch):
+			model(batch).sum().backward()
+
+		def steady_state():
+			start = time.perf_counter()
+			for batch in batches[1:]:
+				step(batch)
+			return (time.perf_counter() - start) / repeats * 1e3
+
+		model.train()
+		step(batches[0])
+		eager = steady_state()
+		model.eval()
+		with torch.no_grad():
+			reference = model(batches[0])
+
+		torch._dynamo.reset()
+		num_graphs = torch._dynamo.explain(model)(batches[0]).graph_count
+
+		model.train()
+		model.compile()
+		start = time.perf_counter()
+		step(batches[0])
+		compile_time = time.perf_counter() - start
+		compiled = steady_state()
+
+		model.eval()
+		with torch.no_grad():
+			out = model(batches[0])
+
+		print('{0:<14}{1:>8}{2:>12.1f}{3:>12.2f}{4:>14.2f}{5:>16.2e}'.format(
+			name, num_graphs, compile_time, eager, compiled, ((out - reference).abs().max() / reference.abs().max()).item(),
+		))
+
+
+def bench_checkpointing(graph, split_idx, batch_size=32, fanout=100, num_layers=(3, 6), scales=(1.5, 2, 3, 4, 6, 8)):
+	'''
+	peak memory of a training step of each model without and with activation checkpointing (one layer per block) and
+	the step time overhead of the recomputation, then the largest batch size and fanout (multiples of the defaults in
+	scales) whose checkpointed step fits in the peak memory of the default step without checkpointing
+	'''
+	graph = prepare_graph(graph)
+	csr = to_csr(graph.edge_index, graph.num_nodes)
+
+	def sample(size, num_neighbours):
+		return next(iter(NeighbourSampler(graph, csr, split_idx['train'], num_neighbours, size))).clone()
+
+	models = {
+		'GNN_SAGE': lambda layers: GNN('SAGE', num_layers=layers),
+		'GNN_GAT': lambda layers: GNN('GAT', num_layers=layers),
+		'ATTN_self': lambda layers: AttentionGNN(attention_type='self', num_layers=layers),
+		'ATTN_feature': lambda layers: AttentionGNN(attention_type='feature', num_layers=layers),
+	}
+	batch = sample(batch_size, fanout)
+
+	print('{0:<14}{1:>8}{2:>10}{3:>10}{4:>12}{5:>12}{6:>12}'.format('model', 'layers', 'peak MB', 'ckpt MB', 'time x', 'max batch', 'max fanout'))
+	for name, create in models.items():
+		for layers in num_layers:
+			torch.manual_seed(0)
+			model = create(layers).train()
+
+			def step(batch):
+				model(batch).sum().backward()
+
+			model.checkpoint_block = 0
+			budget = peak_memory(lambda: step(batch))
+			eager_time = time_fn(lambda: step(batch), repeats=3)
+
+			model.checkpoint_block = 1
+			checkpointed = peak_memory(lambda: step(batch))
+			overhead = time_fn(lambda: step(batch), repeats=3) / eager_time
+
+			# grow the batch size, then the fanout, until the checkpointed step no longer fits in the budget
+			max_batch, max_fanout = batch_size, fanout
+			for scale in scales:
+				larger = sample(int(batch_size * scale), fanout)
+				if peak_memory(lambda: step(larger)) > budget:
+					break
+				max_batch = int(batch_size * scale)
+			for scale in scales:
+				larger = sample(batch_size, int(fanout * scale))
+				if peak_memory(lambda: step(larger)) > budget:
+					break
+				max_fanout = int(fanout * scale)
+
+			print('{0:<14}{1:>8}{2:>10.1f}{3:>10.1f}{4:>12.2f}{5:>12}{6:>12}'.format(name, layers, budget, checkpointed, overhead, max_batch, max_fanout))
+
+
+benchmarks = {
+	'edge_quant': bench_edge_quant,
+	'sampler': bench_sampler,
+	'labels': bench_labels,
+	'edge_scoring': bench_edge_scoring,
+	'edge_cache': bench_edge_cache,
+	'heads': bench_heads,
+	'bucketed_attention': bench_bucketed_attention,
+	'linear_attention': bench_linear_attention,
+	'compile': bench_compile,
+	'mixed_precision': bench_mixed_precision,
+	'checkpointing': bench_checkpointing,
+}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('benchmark', choices=list(benchmarks.keys()))
+	parser.add_argument('--nodes', type=int, default=20000)
+	parser.add_argument('--degree', type=int, default=100)
+	args = parser.parse_args()
+
+	torch.manual_seed(0)
+	graph, split_idx = synthetic_graph(args.nodes, args.degree)
+	benchmarks[args.benchmark](graph, split_idx)
@@ -0,0 +1,146 @@
+import os
+import json
+import fcntl
+import tempfile
+import numpy as np
+import torch
+from contextlib import contextmanager
+
+# increment whenever the preprocessing changes so that stale caches are not reused
+CACHE_VERSION = 4
+
+
+def save_array(path, tensor):
+	'''
+	save a tensor as a raw .npy file, written to a uniquely named temporary file first so that readers never see a partial
+	array and concurrent writers never share a temporary file
+	params:
+		- path: location to save the array to, must end with .npy
+		- tensor: tensor to save
+	'''
+	assert path.endswith('.npy')
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp.npy')
+	try:
+		with os.fdopen(fd, 'wb') as fp:
+			np.save(fp, tensor.detach().cpu().numpy())
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+
+
+def write_json(path, obj):
+	'''
+	write an object as json, to a uniquely named temporary file first so that an interrupted or concurrent write never
+	leaves a corrupt file
+	'''
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp.json')
+	try:
+		with os.fdopen(fd, 'w') as fp:
+			json.dump(obj, fp)
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.remove(tmp_path)
+		raise
+
+
+@contextmanager
+def locked(directory):
+	'''
+	hold an exclusive lock on a directory (through its meta.lock file) between processes
+	'''
+	with open(os.path.join(directory, 'meta.lock'), 'a') as fp:
+		fcntl.flock(fp, fcntl.LOCK_EX)
+		try:
+			yield
+		finally:
+			fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def load_array(path):
+	'''
+	memory-map a .npy file and return it as a tensor, pages are copy-on-write so they are shared
+	between processes through the OS page cache until written to
+	params:
+		- path: location of the .npy file
+	'''
+	return torch.from_numpy(np.load(path, mmap_mode='c'))
+
+
+class PreprocessCache():
+	'''
+	On-disk cache of the arrays GraphTrainer computes before training. Graph level arrays (node features and CSR adjacency)
+	are keyed by dataset, label arrays are additionally keyed by the label mask probability and seed used to create them.
+	The raw dataset can also be stored here as flat arrays so that it is memory-mapped rather than loaded into RAM.
+	params:
+		- root: directory to store the cache in
+		- dataset: name of the dataset being cached
+		- label_mask_p: probability used to mask training labels
+		- seed: seed of the generator used to mask training labels
+	'''
+	def __init__(self, root, dataset='ogbn-proteins', label_mask_p=0.5, seed=0):
+		self.graph_dir = os.path.join(root, dataset, 'v{0}'.format(CACHE_VERSION))
+		self.dataset_dir = os.path.join(self.graph_dir, 'dataset')
+		self.label_dir = os.path.join(self.graph_dir, 'labels_p{0}_s{1}'.format(label_mask_p, seed))
+
+	def names(self, directory):
+		'''
+		returns:
+			list of the names of the complete arrays in a cache directory, or None if none have been written
+		'''
+		meta_path = os.path.join(directory, 'meta.json')
+		if not os.path.exists(meta_path):
+			return None
+
+		with open(meta_path) as fp:
+			meta = json.load(fp)
+
+		if meta['version'] != CACHE_VERSION:
+			return None
+
+		return meta['arrays']
+
+	def load(self, directory):
+		'''
+		memory-map every array in a cache directory
+		returns:
+			Dictionary of array name to tensor, or None if the directory has not been fully written
+		'''
+		names = self.names(directory)
+		if names is None:
+			return None
+
+		return {name: load_array(os.path.join(directory, name + '.npy')) for name in names}
+
+	def save(self, directory, arrays):
+		'''
+		save a dictionary of tensors to a cache directory, adding to any arrays already stored there. meta.json is written
+		last and marks the arrays as complete, it is updated under a lock so that processes saving at once keep each
+		other's arrays
+		'''
+		os.makedirs(directory, exist_ok=True)
+
+		for name, tensor in arrays.items():
+			save_array(os.path.join(directory, name + '.npy'), tensor)
+
+		with locked(directory):
+			names = (self.names(directory) or []) + [name for name in arrays]
+			write_json(os.path.join(directory, 'meta.json'), {'version': CACHE_VERSION, 'arrays': list(dict.fromkeys(names))})
+
+	def load_dataset(self):
+		return self.load(self.dataset_dir)
+
+	def save_dataset(self, arrays):
+		self.save(self.dataset_dir, arrays)
+
+	def load_graph(self):
+		return self.load(self.graph_dir)
+
+	def save_graph(self, arrays):
+		self.save(self.graph_dir, arrays)
+
+	def load_labels(self):
+		return self.load(self.label_dir)
+
+	def save_labels(self, arrays):
+		self.save(self.label_dir, arrays)
@@ -1,2 +1,3 @@
 device = 'cuda:0'
-protein_path = 'F:\Dev\datasets'
\ No newline at end of file
+protein_path = 'F:\Dev\datasets'
+cache_path = 'F:\Dev\datasets\cache'
\ No newline at end of file
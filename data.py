@@ -1,10 +1,27 @@
 import config
+import torch
+from collections import namedtuple
 from ogb.nodeproppred import PygNodePropPredDataset
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader, BatchSampler, RandomSampler, SequentialSampler
+from torch_geometric.data import Data
+from cache import PreprocessCache
+
+# compressed sparse row adjacency over target nodes, row i holds the incoming neighbours of node i
+# perm maps each CSR position to its position in graph.edge_index, it is None when edges are already sorted by target
+CSR = namedtuple('CSR', ['indptr', 'indices', 'perm'])
 
 class graph_dataset(Dataset):
-	def __init__(self, graph, indicies):
-		self.edges = graph.adj_t
+	'''
+	Node level dataset over the CSR adjacency of a graph. Indexing with a tensor (or list) of positions gathers the neighbour
+	slices and label rows of all of them in one vectorised call, use batch_loader to load one batch per call. Every index
+	returns packed (ptr, indices, y) tensors, an int index is a batch of one node.
+	params:
+		- graph: graph to index
+		- indicies: node indexes the dataset covers, e.g. split_idx['train']
+		- csr (optional): CSR adjacency of the graph, built from graph.edge_index if not provided
+	'''
+	def __init__(self, graph, indicies, csr=None):
+		self.csr = csr if csr is not None else to_csr(graph.edge_index, graph.num_nodes)
 		self.y = graph.y
 		self.indices = indicies
 
@@ -12,14 +29,357 @@ class graph_dataset(Dataset):
 		return len(self.indices)
 
 	def __getitem__(self, idx):
-		i = self.indices[idx]
-		return self.edges[i], self.y[i]
+		if isinstance(idx, int):
+			idx = [idx]
+
+		nodes = self.indices[torch.as_tensor(idx, dtype=torch.long)]
+		ptr, pos = gather_csr(self.csr.indptr, nodes)
+		return ptr, self.csr.indices[pos], self.y[nodes]
+
+
+def batch_loader(dataset, batch_size, shuffle=False):
+	'''
+	create a DataLoader which indexes a graph_dataset once per batch rather than once per node
+	returns:
+		DataLoader yielding packed (ptr, indices, y) tensors
+	'''
+	sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+	return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None)
+
+
+def gather_csr(indptr, nodes):
+	'''
+	find the CSR positions of the neighbour slices of a set of nodes
+	params:
+		- indptr: CSR row pointers
+		- nodes: tensor of node indexes
+	returns:
+		ptr of the packed slices and tensor of CSR positions, slice i is pos[ptr[i]:ptr[i+1]]
+	'''
+	start = indptr[nodes]
+	deg = indptr[nodes + 1] - start
+
+	ptr = torch.zeros(nodes.numel() + 1, dtype=torch.long)
+	torch.cumsum(deg, dim=0, out=ptr[1:])
+
+	# shift a running count so that each slice starts at its row pointer
+	pos = torch.arange(int(ptr[-1])) + torch.repeat_interleave(start - ptr[:-1], deg)
+
+	return ptr, pos
+
+
+def is_sorted_by_target(edge_index):
+	'''
+	returns:
+		True if the edges are grouped by target node (CSR order)
+	'''
+	target = edge_index[1]
+	return bool((target[1:] >= target[:-1]).all())
+
+
+def to_csr(edge_index, num_nodes):
+	'''
+	convert a COO edge index into CSR format grouped by target node
+	params:
+		- edge_index: [2, num_edges] tensor of (source, target) pairs
+		- num_nodes: number of nodes in the graph
+	returns:
+		CSR tuple of (indptr, indices, perm)
+	'''
+	target = edge_index[1]
+
+	# row pointers from the in-degree of each node
+	indptr = torch.zeros(num_nodes + 1, dtype=torch.long)
+	torch.cumsum(torch.bincount(target, minlength=num_nodes), dim=0, out=indptr[1:])
+
+	# avoid sorting if the edges are already grouped by target
+	if is_sorted_by_target(edge_index):
+		return CSR(indptr, edge_index[0], None)
+
+	perm = torch.sort(target, stable=True)[1]
+	return CSR(indptr, edge_index[0][perm], perm)
+
+
+def quantise_edge_attr(edge_attr, dtype=torch.uint8):
+	'''
+	convert edge features (confidence scores in [0, 1]) to a compact storage type, models dequantise them in their edge
+	projection (see models.transformers.EdgeLinear)
+	params:
+		- edge_attr: float edge features
+		- dtype: storage type, torch.uint8 (255 quantisation steps) or torch.float16
+	returns:
+		Edge features in the compact storage type
+	'''
+	if dtype == torch.uint8:
+		return edge_attr.mul(255.).round_().to(torch.uint8)
+	elif dtype == torch.float16:
+		return edge_attr.to(torch.float16)
+	else:
+		raise Exception('quantise_edge_attr(): dtype "' + str(dtype) + '" not supported')
+
+
+def aggregate_edge_attr(edge_attr, index, num_nodes, reduce=('mean',), chunk_size=2**22):
+	'''
+	aggregate edge features onto nodes by walking the edges in fixed size chunks and accumulating running statistics, so
+	only one chunk of edges is ever materialised. Works directly on memory-mapped and quantised (uint8) edge features.
+	params:
+		- edge_attr: [num_edges, edge_dim] edge features
+		- index: node index each edge is aggregated onto
+		- num_nodes: number of nodes in the graph
+		- reduce: reductions to compute, any of 'sum', 'mean', 'max', 'min', 'std'
+		- chunk_size: number of edges processed at once
+	returns:
+		[num_nodes, edge_dim * len(reduce)] tensor of the reductions concatenated in order, nodes without edges are zero
+	'''
+	for r in reduce:
+		if r not in ['sum', 'mean', 'max', 'min', 'std']:
+			raise Exception('aggregate_edge_attr(): reduction "' + r + '" not recognised')
+
+	edge_dim = edge_attr.size(-1)
+	count = torch.zeros(num_nodes, dtype=torch.float64)
+	total = torch.zeros(num_nodes, edge_dim, dtype=torch.float64)
+	total_sq = torch.zeros(num_nodes, edge_dim, dtype=torch.float64) if 'std' in reduce else None
+	maximum = torch.full((num_nodes, edge_dim), -float('inf')) if 'max' in reduce else None
+	minimum = torch.full((num_nodes, edge_dim), float('inf')) if 'min' in reduce else None
+
+	for start in range(0, edge_attr.size(0), chunk_size):
+		idx = index[start:start + chunk_size].to(torch.long)
+		chunk = edge_attr[start:start + chunk_size].to(torch.float32)
+		if edge_attr.dtype == torch.uint8:
+			chunk /= 255.
+
+		count.index_add_(0, idx, torch.ones(idx.numel(), dtype=torch.float64))
+		total.index_add_(0, idx, chunk.to(torch.float64))
+		if total_sq is not None:
+			total_sq.index_add_(0, idx, chunk.to(torch.float64).square())
+		if maximum is not None:
+			maximum.scatter_reduce_(0, idx.unsqueeze(-1).expand_as(chunk), chunk, reduce='amax')
+		if minimum is not None:
+			minimum.scatter_reduce_(0, idx.unsqueeze(-1).expand_as(chunk), chunk, reduce='amin')
+
+	has_edges = count.gt(0).unsqueeze(-1)
+	mean = total / count.clamp(min=1).unsqueeze(-1)
+
+	out = []
+	for r in reduce:
+		if r == 'sum':
+			out.append(total)
+		elif r == 'mean':
+			out.append(mean)
+		elif r == 'max':
+			out.append(maximum.where(has_edges, torch.zeros(())))
+		elif r == 'min':
+			out.append(minimum.where(has_edges, torch.zeros(())))
+		elif r == 'std':
+			out.append((total_sq / count.clamp(min=1).unsqueeze(-1) - mean.square()).clamp(min=0).sqrt())
+
+	return torch.cat(out, dim=-1).to(torch.float32)
+
+
+def pack_bits(bits):
+	'''
+	pack the last dimension of a boolean tensor into bytes, bit j of byte i holds element i * 8 + j
+	params:
+		- bits: [..., n] boolean tensor
+	returns:
+		[..., ceil(n / 8)] uint8 tensor
+	'''
+	bits = bits.to(torch.uint8)
+	pad = -bits.size(-1) % 8
+	if pad:
+		bits = torch.cat([bits, bits.new_zeros(*bits.shape[:-1], pad)], dim=-1)
+	bits = bits.view(*bits.shape[:-1], -1, 8) << torch.arange(8, dtype=torch.uint8)
+	return bits.sum(dim=-1, dtype=torch.uint8)
 
 
-def get_graph_data():
+# row i holds the 8 bits of byte value i, unpacking by table lookup is several times faster than shifting and masking
+BYTE_BITS = (torch.arange(256).unsqueeze(-1) >> torch.arange(8)).bitwise_and(1).to(torch.float)
+
+
+def unpack_bits(packed, num_bits=None, dtype=torch.bool):
+	'''
+	unpack bytes created with pack_bits
+	params:
+		- packed: [..., m] uint8 tensor
+		- num_bits (optional): number of leading bits of the last dimension to keep, all 8 * m by default
+		- dtype: type of the unpacked bits
+	returns:
+		[..., num_bits] tensor of 0 and 1
+	'''
+	bits = torch.nn.functional.embedding(packed.reshape(-1).long(), BYTE_BITS).view(*packed.shape[:-1], -1)
+	bits = bits if num_bits is None else bits[..., :num_bits]
+	return bits if dtype == torch.float else bits.to(dtype)
+
+
+def lookup_bits(packed, index):
+	'''
+	read single bits from a packed bit vector
+	params:
+		- packed: [ceil(n / 8)] uint8 tensor created with pack_bits
+		- index: tensor of bit indexes to read
+	returns:
+		boolean tensor shaped like index
+	'''
+	return (packed[index >> 3] >> (index & 7).to(torch.uint8)).bitwise_and_(1).bool()
+
+
+class LabelMask():
+	'''
+	Label observation mask of the training nodes stored as one bit per node and redrawn during training, it is applied to
+	the labels of the sampled nodes only when a batch is collated, so no graph sized label tensor is created. Validation
+	and test labels are never observed. Use as the transform of a training loader.
+	params:
+		- num_nodes: number of nodes in the graph
+		- train_idx: nodes whose labels can be observed
+		- label_mask_p: probability that the labels of a training node are masked
+		- mode: 'epoch' draws the mask of every node when redraw is called (once per epoch), 'batch' draws it for the nodes
+		  of every batch independently
+		- seed: seed of the generator used to draw the mask
+	'''
+	def __init__(self, num_nodes, train_idx, label_mask_p=0.5, mode='epoch', seed=0):
+		if mode not in ['epoch', 'batch']:
+			raise Exception('LabelMask: mode "' + str(mode) + '" not recognised')
+
+		self.num_nodes = num_nodes
+		self.train_idx = train_idx
+		self.label_mask_p = label_mask_p
+		self.mode = mode
+		self.generator = torch.Generator().manual_seed(seed)
+
+		is_train = torch.zeros(num_nodes, dtype=torch.bool)
+		is_train[train_idx] = True
+		self.is_train = pack_bits(is_train)
+		self.observed = None
+		if mode == 'epoch':
+			self.redraw()
+
+	def redraw(self):
+		'''
+		draw a new observation mask for every training node, only used in epoch mode
+		'''
+		observed = torch.zeros(self.num_nodes, dtype=torch.bool)
+		observed[self.train_idx] = torch.rand(self.train_idx.numel(), generator=self.generator).ge(self.label_mask_p)
+		self.observed = pack_bits(observed)
+
+	def lookup(self, n_id):
+		'''
+		returns:
+			boolean tensor of whether the labels of each node of n_id are observed, drawn anew on every call in batch mode
+		'''
+		if self.mode == 'batch':
+			# a node sampled twice in a batch may be observed in one copy only
+			observed = lookup_bits(self.is_train, n_id)
+			observed &= torch.rand(n_id.numel(), generator=self.generator).ge(self.label_mask_p)
+			return observed
+		return lookup_bits(self.observed, n_id)
+
+	def __call__(self, batch):
+		'''
+		set batch.train_masked_y to the labels of the batch's observed nodes (batch.n_id) and zero for the rest
+		'''
+		batch.train_masked_y = self.lookup(batch.n_id).unsqueeze(-1).to(torch.float) * batch.y
+		return batch
+
+
+def get_graph_data(mmap=False):
+	'''
+	load the ogbn-proteins graph and its split indexes
+	params:
+		- mmap: if True every tensor of the graph is memory-mapped from flat arrays under config.cache_path, see get_mmap_graph_data
+	returns:
+		graph and dictionary of split (train | valid | test) indexes
+	'''
+	if mmap:
+		return get_mmap_graph_data()
+
 	data = PygNodePropPredDataset(name='ogbn-proteins', root=config.protein_path)
 	split_idx = data.get_idx_split()
 
 	graph = data[0]
 
-	return graph, split_idx
\ No newline at end of file
+	return graph, split_idx
+
+
+def get_mmap_graph_data(root=config.cache_path):
+	'''
+	load the ogbn-proteins graph with all tensors backed by memory-mapped files. On first use the dataset is converted
+	into flat arrays with edges sorted by target node (CSR order), after which the dataset is never loaded into RAM again.
+	Pages are shared between processes through the OS page cache, so peak memory is the working set of each process.
+	params:
+		- root: directory of the preprocessing cache to store the flat arrays in
+	returns:
+		graph and dictionary of split (train | valid | test) indexes
+	'''
+	cache = PreprocessCache(root)
+	arrays = cache.load_dataset()
+
+	if arrays is None:
+		# convert the dataset once
+		graph, split_idx = get_graph_data()
+		csr = to_csr(graph.edge_index, graph.num_nodes)
+		edge_attr = graph.edge_attr if csr.perm is None else graph.edge_attr[csr.perm]
+		target = torch.repeat_interleave(torch.arange(graph.num_nodes), csr.indptr.diff())
+
+		cache.save_dataset({
+			'indptr': csr.indptr,
+			'edge_index': torch.stack([csr.indices, target]),
+			'edge_attr': edge_attr,
+			'y': graph.y,
+			'node_species': graph.node_species,
+			'train_idx': split_idx['train'],
+			'valid_idx': split_idx['valid'],
+			'test_idx': split_idx['test'],
+		})
+		del graph, csr, edge_attr, target
+		arrays = cache.load_dataset()
+
+	graph = Data(
+			edge_index=arrays['edge_index'],
+			edge_attr=arrays['edge_attr'],
+			y=arrays['y'],
+			node_species=arrays['node_species'],
+			num_nodes=arrays['indptr'].numel() - 1,
+		)
+	split_idx = {s: arrays[s + '_idx'] for s in ['train', 'valid', 'test']}
+
+	return graph, split_idx
+
+
+# bits of the per-node label flags stored alongside packed labels
+TRAIN_OBSERVED = 1
+EVAL_OBSERVED = 2
+
+
+def pack_labels(y, train_observed, eval_observed):
+	'''
+	pack binary labels into bits, with a flag byte per node recording whether its labels are observed
+	params:
+		- y: [num_nodes, num_labels] binary labels
+		- train_observed: [num_nodes] boolean tensor of nodes whose labels are observed in training
+		- eval_observed: [num_nodes] boolean tensor of nodes whose labels are observed in evaluation
+	returns:
+		[num_nodes, ceil(num_labels / 8)] uint8 tensor of packed labels and [num_nodes] uint8 tensor of flags
+	'''
+	flags = train_observed.to(torch.uint8) * TRAIN_OBSERVED + eval_observed.to(torch.uint8) * EVAL_OBSERVED
+	return pack_bits(y.bool()), flags
+
+
+def unpack_labels(batch, num_labels=None):
+	'''
+	replace the packed labels (y_packed and label_flags) of a batch with y, train_masked_y and eval_masked_y for the nodes
+	of the batch, in the types the models use
+	params:
+		- batch: batch collated from a graph with packed labels
+		- num_labels (optional): number of labels per node, all packed bits by default
+	returns:
+		the batch
+	'''
+	y = unpack_bits(batch.y_packed, num_labels, dtype=torch.float)
+	flags = batch.label_flags.unsqueeze(-1)
+
+	batch.y = y.long()
+	batch.train_masked_y = y * flags.bitwise_and(TRAIN_OBSERVED).bool()
+	batch.eval_masked_y = y * flags.bitwise_and(EVAL_OBSERVED).bool()
+
+	del batch.y_packed, batch.label_flags
+	return batch
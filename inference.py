@@ -0,0 +1,321 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+import config
+from collections import OrderedDict
+from cache import PreprocessCache, write_json
+from data import CSR, get_mmap_graph_data
+from sampler import chunk_by_edges, full_neighbour_batch
+
+
+def fingerprint(tensors):
+	'''
+	hash the contents of a sequence of tensors, or of (name, tensor) pairs such as state_dict().items()
+	returns:
+		hex digest of the names, dtypes, shapes and values of the tensors
+	'''
+	h = hashlib.sha1()
+	for t in tensors:
+		if isinstance(t, tuple):
+			h.update(t[0].encode())
+			t = t[1]
+		t = t.detach().cpu().contiguous()
+		h.update((str(t.dtype) + str(tuple(t.shape))).encode())
+		h.update(t.reshape(-1).view(torch.uint8).numpy().tobytes())
+	return h.hexdigest()
+
+
+class PredictionEngine():
+	'''
+	Streams model predictions into a memory-mapped [num_nodes, out_dim] .npy file as chunks of target nodes complete, so
+	memory stays flat however many nodes are scored. Progress is recorded after every chunk and an interrupted run
+	resumes from the last completed chunk, provided the model weights and node list are unchanged (both are hashed into the
+	progress file). The progress file is removed once every chunk is written. Each chunk holds every incoming edge of its nodes, see sampler.FullNeighbourLoader.
+	params:
+		- graph: preprocessed graph (see GraphTrainer.preprocess) to score nodes of
+		- csr: CSR adjacency of the graph
+		- max_edges: maximum number of edges in a chunk
+		- device: device to run the model on
+	'''
+	def __init__(self, graph, csr, max_edges=2**20, device=config.device):
+		self.graph = graph
+		self.csr = csr
+		self.max_edges = max_edges
+		self.device = device
+
+	def predict(self, model, nodes, out_path, out_dim=112, resume=True):
+		'''
+		score nodes and write their logits to row node_id of out_path, rows of other nodes are left as zero
+		params:
+			- model: model to score nodes with
+			- nodes: tensor of node indexes to score
+			- out_path: .npy file to write predictions to, progress is stored alongside it
+			- out_dim: dimension of the model output
+			- resume: continue an interrupted run with the same model, nodes and chunking rather than starting again
+		returns:
+			[num_nodes, out_dim] tensor memory-mapped from out_path
+		'''
+		assert out_path.endswith('.npy')
+		progress_path = out_path[:-len('.npy')] + '.progress.json'
+
+		chunks = chunk_by_edges(self.csr, nodes, self.max_edges)
+		progress = {
+			'model': fingerprint(model.state_dict().items()),
+			'nodes': fingerprint([nodes.long()]),
+			'max_edges': self.max_edges,
+			'num_chunks': len(chunks),
+			'completed': 0,
+		}
+
+		# only resume if the previous run scored the same nodes in the same chunks with the same model
+		if resume and os.path.exists(progress_path) and os.path.exists(out_path):
+			with open(progress_path) as fp:
+				previous = json.load(fp)
+			if all(previous.get(k) == progress[k] for k in ['model', 'nodes', 'max_edges', 'num_chunks']):
+				progress['completed'] = previous['completed']
+
+		if progress['completed'] > 0:
+			out = np.load(out_path, mmap_mode='r+')
+		else:
+			out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=(self.graph.num_nodes, out_dim))
+			write_json(progress_path, progress)
+
+		model.to(self.device)
+		model.eval()
+		with torch.no_grad():
+			for i in range(progress['completed'], len(chunks)):
+				batch = full_neighbour_batch(self.graph, self.csr, chunks[i])
+				pred_y = model(batch.to(self.device))[:batch.batch_size]
+				out[chunks[i].numpy()] = pred_y.cpu().numpy()
+
+				# flush the chunk to disk before recording it as complete
+				out.flush()
+				progress['completed'] = i + 1
+				write_json(progress_path, progress)
+
+		# a finished run is never resumed, later runs to out_path start again
+		out.flush()
+		if os.path.exists(progress_path):
+			os.remove(progress_path)
+
+		return torch.from_numpy(out)
+
+
+class LayerwiseInference():
+	'''
+	Full graph inference for multi-layer GNN and AttentionGNN models, one layer at a time. Layer 1 is computed for every
+	node from the full neighbourhood and stored in a memory-mapped embedding cache, layer 2 is computed from that cache
+	and so on, so each layer costs one pass over the edges rather than recomputing shared neighbours per target node.
+	The cached embeddings (layer_<i>.npy in cache_dir) can be reused for analysis or to re-score nodes, they are only
+	reused by a run with the same model weights, number of layers and chunking. Batches have the
+	one-hop layout used in training, so degree normalised layers (GCN) see each neighbour with a degree of one.
+	params:
+		- graph: preprocessed graph (see GraphTrainer.preprocess) to score nodes of
+		- csr: CSR adjacency of the graph
+		- cache_dir: directory to store the per layer embeddings in
+		- max_edges: maximum number of edges in a chunk
+		- device: device to run the model on
+	'''
+	def __init__(self, graph, csr, cache_dir, max_edges=2**20, device=config.device):
+		self.graph = graph
+		self.csr = csr
+		self.cache_dir = cache_dir
+		self.max_edges = max_edges
+		self.device = device
+
+	def layer_path(self, i):
+		return os.path.join(self.cache_dir, 'layer_{0}.npy'.format(i))
+
+	def embeddings(self, i):
+		'''
+		returns:
+			[num_nodes, dim] tensor of the cached output of layer i, memory-mapped from the cache
+		'''
+		return torch.from_numpy(np.load(self.layer_path(i), mmap_mode='r+'))
+
+	def run(self, model, reuse=False):
+		'''
+		compute and cache the output of every layer of a model for every node
+		params:
+			- model: GNN or AttentionGNN model, must implement input_features and layer_forward
+			- reuse: keep layers already cached by a previous run of the same model (weights and number of layers) and
+			  max_edges, otherwise every layer is recomputed
+		returns:
+			[num_nodes, out_dim] tensor of model outputs memory-mapped from the cache
+		'''
+		if not hasattr(model, 'layer_forward'):
+			raise Exception('LayerwiseInference: model "' + model.param_dict['model_type'] + '" does not support layer-wise inference')
+
+		os.makedirs(self.cache_dir, exist_ok=True)
+		meta_path = os.path.join(self.cache_dir, 'meta.json')
+		meta = {
+			'model': fingerprint(model.state_dict().items()),
+			'num_layers': len(model.layers),
+			'max_edges': self.max_edges,
+			'completed': 0,
+		}
+
+		# only reuse layers cached by the same model with the same chunking
+		if reuse and os.path.exists(meta_path):
+			with open(meta_path) as fp:
+				previous = json.load(fp)
+			if all(previous.get(k) == meta[k] for k in ['model', 'num_layers', 'max_edges']):
+				meta['completed'] = previous['completed']
+		completed = meta['completed']
+		write_json(meta_path, meta)
+
+		chunks = chunk_by_edges(self.csr, torch.arange(self.graph.num_nodes), self.max_edges)
+
+		model.to(self.device)
+		model.eval()
+		with torch.no_grad():
+			for i in range(completed, len(model.layers)):
+				previous = self.embeddings(i - 1) if i > 0 else None
+				out = None
+
+				for seeds in chunks:
+					batch = full_neighbour_batch(self.graph, self.csr, seeds).to(self.device)
+
+					# the input of the layer for every node in the batch, each source node is a copy of a graph node
+					x = model.input_features(batch) if previous is None else previous[batch.n_id.cpu()].to(self.device)
+					h = model.layer_forward(i, x, batch)[:batch.batch_size].cpu()
+
+					if out is None:
+						out = np.lib.format.open_memmap(self.layer_path(i), mode='w+', dtype=np.float32, shape=(self.graph.num_nodes, h.size(-1)))
+					out[seeds.numpy()] = h.numpy()
+
+				out.flush()
+				del out
+				meta['completed'] = i + 1
+				write_json(meta_path, meta)
+
+		return self.embeddings(len(model.layers) - 1)
+
+
+class NodePredictor():
+	'''
+	Lightweight scoring of arbitrary node ids with a saved model, gathering the full one-hop neighbourhood of the requested
+	nodes only. Logits and final layer input embeddings of scored nodes are kept in a bounded LRU cache so repeated and
+	overlapping queries are served without recomputation.
+	params:
+		- model: model to score nodes with, its weights are loaded from checkpoint_path if given
+		- graph: preprocessed graph (see GraphTrainer.preprocess) to score nodes of
+		- csr: CSR adjacency of the graph
+		- checkpoint_path (optional): path of a saved model state_dict
+		- cache_size: maximum number of nodes kept in the LRU cache
+		- max_edges: maximum number of edges in a batch of cache misses
+		- device: device to run the model on
+	'''
+	def __init__(self, model, graph, csr, checkpoint_path=None, cache_size=100000, max_edges=2**20, device=config.device):
+		if checkpoint_path:
+			model.load_state_dict(torch.load(checkpoint_path, map_location='cpu'))
+
+		self.model = model.to(device)
+		self.model.eval()
+		self.graph = graph
+		self.csr = csr
+		self.cache_size = cache_size
+		self.max_edges = max_edges
+		self.device = device
+
+		self.cache = OrderedDict()
+		self.hits, self.misses = 0, 0
+
+		# capture the input of the final layer as the node embedding
+		self.embedding = None
+		self.model.layers[-1].register_forward_pre_hook(self.capture_embedding)
+
+	@classmethod
+	def from_cache(cls, model, checkpoint_path, cache_dir=config.cache_path, label_mask_p=0.5, seed=0, node_features=('mean',), **kwargs):
+		'''
+		create a predictor from the memory-mapped dataset and preprocessing cache written by GraphTrainer, without loading
+		the dataset into RAM or recomputing anything
+		params:
+			- model: model to score nodes with
+			- checkpoint_path: path of a saved model state_dict
+			- cache_dir: directory of the preprocessing cache
+			- label_mask_p, seed, node_features: settings of the GraphTrainer which wrote the cache
+		'''
+		graph, _ = get_mmap_graph_data(cache_dir)
+		cache = PreprocessCache(cache_dir, label_mask_p=label_mask_p, seed=seed)
+		graph_arrays, label_arrays = cache.load_graph(), cache.load_labels()
+		if graph_arrays is None or label_arrays is None:
+			raise Exception('NodePredictor.from_cache(): no preprocessed graph in "' + cache_dir + '", run a GraphTrainer with cache_dir first')
+
+		graph.x = graph_arrays['x_' + '_'.join(node_features)]
+		graph.eval_masked_y = label_arrays['eval_masked_y']
+
+		# the memory-mapped graph is stored in CSR order
+		csr = CSR(cache.load_dataset()['indptr'], graph.edge_index[0], None)
+
+		return cls(model, graph, csr, checkpoint_path=checkpoint_path, **kwargs)
+
+	def capture_embedding(self, module, args):
+		self.embedding = args[0]
+
+	def stats(self):
+		'''
+		returns:
+			Dictionary of cache hits, misses, hit rate and number of cached nodes
+		'''
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_rate': self.hits / max(self.hits + self.misses, 1),
+			'cached': len(self.cache),
+		}
+
+	def score(self, nodes):
+		'''
+		run the model on a set of nodes and add their logits and embeddings to the cache
+		returns:
+			Dictionary of node index to (logits, embedding)
+		'''
+		scored = {}
+		with torch.no_grad():
+			for seeds in chunk_by_edges(self.csr, nodes, self.max_edges):
+				batch = full_neighbour_batch(self.graph, self.csr, seeds)
+				logits = self.model(batch.to(self.device))[:batch.batch_size].cpu()
+				embeddings = self.embedding[:batch.batch_size].cpu()
+
+				for node, l, e in zip(seeds.tolist(), logits, embeddings):
+					scored[node] = (l, e)
+
+		self.cache.update(scored)
+
+		# evict the least recently used nodes
+		while len(self.cache) > self.cache_size:
+			self.cache.popitem(last=False)
+
+		return scored
+
+	def predict(self, node_ids, return_embeddings=False):
+		'''
+		score a list of nodes, serving cached nodes without recomputation
+		params:
+			- node_ids: list or tensor of node indexes
+			- return_embeddings: also return the final layer input embedding of each node
+		returns:
+			[num_nodes, 112] tensor of logits, and [num_nodes, hid_dim] tensor of embeddings if return_embeddings
+		'''
+		node_ids = torch.as_tensor(node_ids, dtype=torch.long).view(-1).tolist()
+
+		results = {}
+		for n in node_ids:
+			if n in self.cache:
+				self.cache.move_to_end(n)
+				results[n] = self.cache[n]
+				self.hits += 1
+			else:
+				self.misses += 1
+
+		missing = [n for n in dict.fromkeys(node_ids) if n not in results]
+		if missing:
+			results.update(self.score(torch.tensor(missing)))
+
+		logits = torch.stack([results[n][0] for n in node_ids])
+		if return_embeddings:
+			return logits, torch.stack([results[n][1] for n in node_ids])
+		return logits
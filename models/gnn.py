@@ -1,5 +1,6 @@
 import torch
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch_geometric.nn.dense.linear import Linear
 
 from torch_geometric.nn import GCNConv, SAGEConv, GATConv, TransformerConv
@@ -14,6 +15,8 @@ class GNN(torch.nn.Module):
 		- out_dim = the dimensionality of the output
 		- num_layers = the number of hidden layers to use between the input and output layers
 		- dropout = the dropout probability to use
+		- checkpoint_block = number of consecutive layers whose activations are recomputed together in the backward pass
+		  rather than stored (activation checkpointing), 0 to store every activation
 	'''
 	def __init__(
 			self,
@@ -24,12 +27,13 @@ class GNN(torch.nn.Module):
 			out_dim = 112,
 			num_layers = 3,
 			dropout = 0.25,
+			checkpoint_block = 0,
 			):
 		super(GNN, self).__init__()
 
 		# create a parameter dictionary to store information about the model, used for logging experiments
 		self.param_dict = {'model_type':'GNN_' + conv_type, 'propagation':propagation, 'in_dim':in_dim, 'hid_dim':hid_dim, 'out_dim':out_dim, 'layers':num_layers,
-							'dropout':dropout}
+							'dropout':dropout, 'checkpoint':checkpoint_block}
 		
 		self.propagation = propagation
 		if self.propagation == 'both':
@@ -62,12 +66,17 @@ class GNN(torch.nn.Module):
 			layer(hid_dim, out_dim))
 
 		self.dropout = dropout
+		self.checkpoint_block = checkpoint_block
 
 	def reset_parameters(self):
 		for layer in self.layers:
 			layer.reset_parameters()
 
-	def forward(self, batch):
+	def input_features(self, batch):
+		'''
+		returns:
+			input of the first layer for every node in the batch
+		'''
 		if self.propagation == 'feature':
 			x = batch.x
 		elif self.propagation == 'label' or self.propagation == 'both':
@@ -88,11 +97,37 @@ class GNN(torch.nn.Module):
 		elif self.propation == 'both':
 			raise NotImplemented
 
-		for layer in self.layers[:-1]:
-			x = layer(x, batch.edge_index)
+		return x
+
+	def layer_forward(self, i, x, batch):
+		'''
+		apply layer i (and its activation if it is not the last layer) to the node representations x of a batch
+		'''
+		x = self.layers[i](x, batch.edge_index)
+		if i < len(self.layers) - 1:
 			x = F.relu(x)
 			x = F.dropout(x, p=self.dropout, training=self.training)
-		x = self.layers[-1](x, batch.edge_index)
+		return x
+
+	def block_forward(self, start, x, batch):
+		'''
+		apply the checkpoint_block layers from layer start to the node representations x of a batch
+		'''
+		for i in range(start, min(start + self.checkpoint_block, len(self.layers))):
+			x = self.layer_forward(i, x, batch)
+		return x
+
+	def forward(self, batch):
+		x = self.input_features(batch)
+
+		# only the inputs of each block are kept for the backward pass, the block's messages are recomputed from them
+		if self.checkpoint_block > 0 and self.training and torch.is_grad_enabled():
+			for start in range(0, len(self.layers), self.checkpoint_block):
+				x = checkpoint(self.block_forward, start, x, batch, use_reentrant=False)
+			return x
+
+		for i in range(len(self.layers)):
+			x = self.layer_forward(i, x, batch)
 		return x
 
 
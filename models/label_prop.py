@@ -1,4 +1,123 @@
 import torch
 
 
-#class 
+class LabelPropagation(torch.nn.Module):
+	'''
+	Label propagation baseline, the known training labels are spread over the symmetrically normalised adjacency
+	D^-1/2 A D^-1/2 by repeated sparse-dense matrix products, out = alpha * A out + (1 - alpha) * Y, until the predictions
+	stop changing. It has no trainable parameters, it is fitted once on the full graph (see GraphTrainer.train) and then
+	scores the target nodes of any batch.
+	params:
+		- num_layers: maximum number of propagation steps
+		- alpha: fraction of each step taken from the neighbours, the rest from the known labels
+		- tol: stop once no prediction changes by more than tol in a step
+		- edge_weight (optional): weight edges by their confidence, 'mean' or 'max' of the edge features
+		- num_threads (optional): number of CPU threads used for the sparse products, the PyTorch default if not given
+		- chunk_size: number of edges whose weights are computed at once
+	'''
+	def __init__(self, num_layers=50, alpha=0.9, tol=1e-4, edge_weight=None, num_threads=None, chunk_size=2**22):
+		super(LabelPropagation, self).__init__()
+
+		# create a parameter dictionary to store information about the model, used for logging experiments
+		self.param_dict = {'model_type':'LP', 'layers':num_layers, 'alpha':alpha, 'tol':tol, 'edge_weight':edge_weight}
+
+		if edge_weight not in [None, 'mean', 'max']:
+			raise Exception('LabelPropagation edge weight "' + str(edge_weight) + '" not recognized')
+
+		self.num_layers = num_layers
+		self.alpha = alpha
+		self.tol = tol
+		self.edge_weight = edge_weight
+		self.num_threads = num_threads
+		self.chunk_size = chunk_size
+
+		self.out = None
+		self.num_steps = 0
+
+	def reset_parameters(self):
+		self.out = None
+		self.num_steps = 0
+
+	def adjacency(self, graph, csr):
+		'''
+		build the normalised adjacency as a sparse CSR matrix, row i aggregates the incoming neighbours of node i
+		params:
+			- graph: graph to propagate over
+			- csr: CSR adjacency of the graph
+		returns:
+			[num_nodes, num_nodes] sparse CSR tensor
+		'''
+		num_edges = csr.indices.numel()
+
+		if self.edge_weight is None:
+			weight = torch.ones(num_edges)
+		else:
+			# edge features are read in CSR order, one chunk at a time
+			weight = torch.empty(num_edges)
+			for start in range(0, num_edges, self.chunk_size):
+				end = min(start + self.chunk_size, num_edges)
+				edge_attr = graph.edge_attr[start:end] if csr.perm is None else graph.edge_attr[csr.perm[start:end]]
+				edge_attr = edge_attr.to(torch.float)
+				weight[start:end] = edge_attr.mean(dim=-1) if self.edge_weight == 'mean' else edge_attr.max(dim=-1)[0]
+
+		# weighted in-degree of each node
+		row = torch.repeat_interleave(torch.arange(csr.indptr.numel() - 1), csr.indptr.diff())
+		deg = torch.zeros(csr.indptr.numel() - 1).index_add_(0, row, weight)
+		deg_inv_sqrt = deg.pow(-0.5)
+		deg_inv_sqrt[deg_inv_sqrt == float('inf')] = 0
+
+		weight.mul_(deg_inv_sqrt[row]).mul_(deg_inv_sqrt[csr.indices])
+		del row
+
+		return torch.sparse_csr_tensor(csr.indptr, csr.indices, weight, size=(deg.numel(), deg.numel()), check_invariants=False)
+
+	def fit(self, graph, csr, train_idx, train_y):
+		'''
+		propagate the training labels over the whole graph
+		params:
+			- graph: graph to propagate over
+			- csr: CSR adjacency of the graph
+			- train_idx: nodes with known labels
+			- train_y: [num_train_nodes, num_labels] labels of the train_idx nodes
+		returns:
+			[num_nodes, num_labels] tensor of the propagated labels, in [0, 1]
+		'''
+		num_threads = torch.get_num_threads()
+		if self.num_threads:
+			torch.set_num_threads(self.num_threads)
+
+		try:
+			adj = self.adjacency(graph, csr)
+
+			y = torch.zeros(graph.num_nodes, train_y.size(-1))
+			y[train_idx] = train_y.to(torch.float)
+
+			out = y.clone()
+			step = 0
+			for step in range(1, self.num_layers + 1):
+				new_out = torch.sparse.mm(adj, out).mul_(self.alpha).add_(y, alpha=1 - self.alpha).clamp_(0, 1)
+				change = (new_out - out).abs().max().item()
+				out = new_out
+				if change < self.tol:
+					break
+		finally:
+			torch.set_num_threads(num_threads)
+
+		self.num_steps = step
+		self.out = out
+		return out
+
+	def predict(self, nodes):
+		'''
+		returns:
+			[num_nodes, num_labels] tensor of logits of a set of nodes
+		'''
+		if self.out is None:
+			raise Exception('LabelPropagation must be fitted before it is used')
+
+		# logits so that the output works with BCEWithLogitsLoss like the trained models
+		return torch.logit(self.out[nodes], eps=1e-6)
+
+	def forward(self, batch):
+		n_id = batch.n_id[:batch.batch_size]
+		return self.predict(n_id.cpu()).to(n_id.device)
@@ -1,9 +1,11 @@
 import math
+from collections import OrderedDict
 from typing import Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 from torch_sparse import SparseTensor
 
 from torch_geometric.nn.conv import MessagePassing
@@ -11,6 +13,286 @@ from torch_geometric.nn.dense.linear import Linear
 from torch_geometric.typing import Adj, OptTensor, PairTensor
 from torch_geometric.utils import softmax
 
+# edge features stored as uint8 are quantised over [0, 1] with this many steps, see data.quantise_edge_attr
+EDGE_QUANT_SCALE = 255.
+
+
+class EdgeProjectionCache():
+	'''
+	Cache of the edge projections (EdgeLinear outputs) of batches, shared by the attention layers of a model, so that
+	evaluating frozen weights on the same batches again (e.g. the fixed validation table of NeighbourTableLoader, or
+	repeated inference) skips projecting their edges. Entries are keyed by layer, by the input and output dtypes (so
+	projections made under bfloat16 autocast are never returned to float32 passes, or the reverse) and by the batch's edge
+	ids, which are checked with torch.equal. A layer's entries are dropped when its parameters change, which optimiser steps and
+	load_state_dict mark by bumping the parameters' version counters. The least recently used entries are evicted beyond
+	max_bytes. Layers in training mode, or with gradients enabled, bypass the cache.
+	params:
+		- max_bytes: maximum total size of the cached projections and their edge ids
+	'''
+	def __init__(self, max_bytes=2**30):
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()
+		self.versions = {}
+		self.num_bytes = 0
+		self.hits, self.misses = 0, 0
+
+	def stats(self):
+		'''
+		returns:
+			Dictionary of cache hits, misses, hit rate, number of cached batch projections and their size in bytes
+		'''
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'hit_rate': self.hits / max(self.hits + self.misses, 1),
+			'entries': len(self.entries),
+			'bytes': self.num_bytes,
+		}
+
+	def clear(self):
+		self.entries.clear()
+		self.versions.clear()
+		self.num_bytes = 0
+
+	def remove(self, key):
+		e_id, projection = self.entries.pop(key)
+		self.num_bytes -= e_id.numel() * e_id.element_size() + projection.numel() * projection.element_size()
+
+	def project(self, layer, edge_attr, e_id):
+		'''
+		project the edge features of a batch with layer, from the cache if the batch's edges were projected with the
+		current parameters before
+		params:
+			- layer: EdgeLinear projection
+			- edge_attr: [num_edges, edge_dim] edge features of the batch
+			- e_id: index of each batch edge in the graph
+		returns:
+			[num_edges, out_dim] tensor of projected edge features
+		'''
+		if layer.training or torch.is_grad_enabled():
+			return layer(edge_attr)
+
+		# drop the layer's projections if its parameters have been updated or replaced since they were cached
+		version = tuple((p.data_ptr(), p._version) for p in layer.parameters())
+		if self.versions.get(id(layer)) != version:
+			for key in [key for key in self.entries if key[0] == id(layer)]:
+				self.remove(key)
+			self.versions[id(layer)] = version
+
+		device_type = edge_attr.device.type
+		dtype = torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else layer.weight.dtype
+		span = (e_id.numel(), int(e_id[0]), int(e_id[-1])) if e_id.numel() > 0 else (0, -1, -1)
+		key = (id(layer), edge_attr.dtype, dtype) + span
+		if key in self.entries and torch.equal(self.entries[key][0], e_id):
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return self.entries[key][1]
+
+		self.misses += 1
+		projection = layer(edge_attr)
+		if key in self.entries:
+			self.remove(key)
+
+		# batches may be backed by reused sampler buffers, so the edge ids are copied
+		num_bytes = e_id.numel() * e_id.element_size() + projection.numel() * projection.element_size()
+		if num_bytes <= self.max_bytes:
+			self.entries[key] = (e_id.clone(), projection)
+			self.num_bytes += num_bytes
+			while self.num_bytes > self.max_bytes:
+				self.remove(next(iter(self.entries)))
+
+		return projection
+
+
+class EdgeLinear(Linear):
+	'''
+	Linear projection of edge features that accepts compact (uint8 or float16) edge feature storage. Quantised inputs are
+	dequantised on the fly by folding the quantisation scale into the weight, so no float copy of the edges is kept.
+	Projections of whole batches can be cached for evaluation by setting cache to an EdgeProjectionCache.
+	'''
+	cache: Optional[EdgeProjectionCache] = None
+
+	def forward(self, x: Tensor) -> Tensor:
+		if x.dtype == torch.uint8:
+			return F.linear(x.to(self.weight.dtype), self.weight / EDGE_QUANT_SCALE, self.bias)
+		return super().forward(x.to(self.weight.dtype))
+
+	def query(self, q: Tensor) -> Tuple[Tensor, Tensor]:
+		'''
+		project attention queries into the edge feature space, since q . (W a + b) = (W^T q) . a + q . b the score of a
+		query against a projected edge can be computed from the raw (edge_dim sized) edge features
+		params:
+			- q: [num_nodes, heads, out_dim] queries, heads * out_dim must be the output size of the projection
+		returns:
+			[num_nodes, heads, edge_dim] projected queries and [num_nodes, heads] tensor of q . b
+		'''
+		H, C = q.size(1), q.size(2)
+		q_edge = torch.einsum('nhc,hcd->nhd', q, self.weight.view(H, C, -1))
+		q_bias = (q * self.bias.view(H, C)).sum(dim=-1) if self.bias is not None else q.new_zeros(q.shape[:2])
+		return q_edge, q_bias
+
+	def project(self, edge_attr: Tensor, e_id: OptTensor = None) -> Tensor:
+		'''
+		project the edge features of a batch, through the cache when there is one and the batch's edge ids are known
+		'''
+		if self.cache is None or e_id is None:
+			return self(edge_attr)
+		return self.cache.project(self, edge_attr, e_id)
+
+	def score(self, q: Tensor, edge_attr: Tensor, index: Tensor, edge_space: bool = True, e_id: OptTensor = None) -> Tensor:
+		'''
+		dot product of the query of each edge's target node with its projected edge features
+		params:
+			- q: [num_nodes, heads, out_dim] queries
+			- edge_attr: [num_edges, edge_dim] edge features
+			- index: target node of each edge
+			- edge_space: project the queries of target nodes into the edge feature space (see query) rather than every
+			  edge to heads * out_dim
+			- e_id (optional): index of each edge in the graph, used to cache projections when edge_space is off
+		returns:
+			[num_edges, heads] tensor of scores
+		'''
+		if not edge_space:
+			return (q.index_select(0, index) * self.project(edge_attr, e_id).view(-1, q.size(1), q.size(2))).sum(dim=-1)
+
+		# only target nodes need projecting, in sampled batches they are the first batch_size nodes. Finding them syncs on
+		# index.max(), which would break a compiled graph, so compiled models project every node instead
+		if torch.compiler.is_compiling():
+			num_targets = q.size(0)
+		else:
+			num_targets = int(index.max()) + 1 if index.numel() > 0 else 0
+		q_edge, q_bias = self.query(q[:num_targets])
+
+		x = (q_edge.index_select(0, index) * edge_attr.to(q_edge.dtype).unsqueeze(1)).sum(dim=-1)
+		if edge_attr.dtype == torch.uint8:
+			x = x / EDGE_QUANT_SCALE
+		return x + q_bias.index_select(0, index)
+
+
+class BucketedAttention():
+	'''
+	Dense execution of neighbourhood attention. Target nodes are grouped by in-degree into buckets, whose incoming edges
+	are gathered into padded [heads, targets, width, dim] blocks, and each block is one batched scaled_dot_product_attention
+	with the edge scores (and padding) as an additive mask. Bucket widths are degrees rounded up to a quarter of their
+	power of two, so at most 25% of a block is padding. Buckets narrower than min_degree, where blocks are too small for
+	batched matmuls to pay off, use the per-edge scatter softmax instead. The bucket plan of the last edge_index is kept,
+	along with a reference to that edge_index, so the layers of a model share it within a batch. Plans are matched by tensor
+	identity rather than storage address, which a freed batch's successor is often allocated at.
+	params:
+		- min_degree: narrowest bucket computed densely, 0 to compute every bucket densely
+		- max_block: maximum number of neighbour slots (targets * width) in a block, larger buckets are split
+	'''
+	def __init__(self, min_degree=16, max_block=2**16):
+		self.min_degree = min_degree
+		self.max_block = max_block
+		self.last_edge_index, self.last_key, self.last_plan = None, None, None
+
+	def plan(self, edge_index, num_nodes):
+		'''
+		group the target nodes of edge_index into dense blocks
+		params:
+			- edge_index: [2, num_edges] edges of the batch
+			- num_nodes: number of nodes in the batch
+		returns:
+			list of [targets, width] padding masks of the dense blocks, the targets of the blocks and their neighbour slots
+			(edge ids, padding filled with 0) concatenated in block order, and a tensor of the edges of the scatter path
+		'''
+		# the cached edge_index is held so its storage cannot be reused, in place edits bump its version counter
+		key = (edge_index._version, num_nodes)
+		if edge_index is self.last_edge_index and key == self.last_key:
+			return self.last_plan
+
+		index = edge_index[1]
+		perm = torch.argsort(index, stable=True)
+		deg = torch.bincount(index, minlength=num_nodes)
+		ptr = torch.cumsum(deg, 0) - deg
+
+		# width of each node's bucket, its degree rounded up to a multiple of a quarter of its power of two
+		step = (2 ** torch.floor(torch.log2(deg.clamp(min=1).to(torch.float))).long() // 4).clamp(min=1)
+		width = (deg + step - 1) // step * step
+		width[deg == 0] = 0
+
+		blocks, dense_targets, dense_edges, scatter_targets = [], [], [], []
+		for w in torch.unique(width).tolist():
+			if w == 0:
+				continue
+			targets = (width == w).nonzero().view(-1)
+			if w < self.min_degree:
+				scatter_targets.append(targets)
+				continue
+
+			offset = torch.arange(w, device=index.device)
+			for chunk in torch.split(targets, max(self.max_block // w, 1)):
+				pad = offset >= deg[chunk].unsqueeze(1)
+				blocks.append(pad)
+				dense_targets.append(chunk)
+				dense_edges.append(perm[(ptr[chunk].unsqueeze(1) + offset).masked_fill(pad, 0)].masked_fill(pad, 0).view(-1))
+
+		# edges of the scatter path, those into targets of the narrow buckets
+		is_scatter = torch.zeros(num_nodes, dtype=torch.bool, device=index.device)
+		if scatter_targets:
+			is_scatter[torch.cat(scatter_targets)] = True
+		scatter_edges = is_scatter[index].nonzero().view(-1)
+
+		empty = index.new_zeros(0)
+		dense_targets = torch.cat(dense_targets) if blocks else empty
+		dense_edges = torch.cat(dense_edges) if blocks else empty
+
+		self.last_edge_index, self.last_key = edge_index, key
+		self.last_plan = (blocks, dense_targets, dense_edges, scatter_edges)
+		return self.last_plan
+
+	def __call__(self, q, k, v, e, edge_index, dropout=0., training=False):
+		'''
+		attention of every target node over its incoming edges, softmax((q_i . k_j + e_ij) / sqrt(dim)) weighted sum of v_j
+		params:
+			- q, k, v: [num_nodes, heads, dim] queries, keys and values of the nodes of the batch
+			- e: [num_edges, heads] edge scores added to the query key products
+			- edge_index: [2, num_edges] edges of the batch
+			- dropout: dropout probability of the attention weights
+			- training: apply dropout
+		returns:
+			[num_nodes, heads, dim] tensor of attended values, zero for nodes without incoming edges
+		'''
+		N, H, C = q.size(0), q.size(1), q.size(2)
+		src, index = edge_index[0], edge_index[1]
+		blocks, dense_targets, dense_edges, scatter_edges = self.plan(edge_index, N)
+		dropout = dropout if training else 0.
+
+		out = q.new_zeros(N, H, C)
+		if blocks:
+			# the inputs of every block are gathered at once, heads first, and split into blocks
+			num_targets, num_slots = [pad.size(0) for pad in blocks], [pad.numel() for pad in blocks]
+			src_dense = src.index_select(0, dense_edges)
+			q_blocks = q.index_select(0, dense_targets).transpose(0, 1).split(num_targets, dim=1)
+			k_blocks = k.index_select(0, src_dense).transpose(0, 1).split(num_slots, dim=1)
+			v_blocks = v.index_select(0, src_dense).transpose(0, 1).split(num_slots, dim=1)
+			e_blocks = e.index_select(0, dense_edges).t().split(num_slots, dim=1)
+
+			x = []
+			for pad, q_b, k_b, v_b, e_b in zip(blocks, q_blocks, k_blocks, v_blocks, e_blocks):
+				B, W = pad.shape
+				# SDPA scales q . k but not the mask, so the edge scores are scaled here
+				mask = (e_b.reshape(H, B, 1, W) / math.sqrt(C)).masked_fill(pad.view(1, B, 1, W), float('-inf'))
+				x.append(F.scaled_dot_product_attention(
+					q_b.unsqueeze(2),
+					k_b.reshape(H, B, W, C),
+					v_b.reshape(H, B, W, C),
+					attn_mask=mask,
+					dropout_p=dropout,
+				).squeeze(2))
+			out = out.index_copy(0, dense_targets, torch.cat(x, dim=1).transpose(0, 1))
+
+		if scatter_edges.numel() > 0:
+			src_e, index_e = src[scatter_edges], index[scatter_edges]
+			x = ((q[index_e] * k[src_e]).sum(dim=-1) + e[scatter_edges]) / math.sqrt(C)
+			alpha = softmax(x, index_e, num_nodes=N)
+			alpha = F.dropout(alpha, p=dropout, training=training)
+			out = out.index_add(0, index_e, v[src_e] * alpha.unsqueeze(-1))
+
+		return out
+
+
 class AttentionGNN(torch.nn.Module):
 	def __init__(
 			self,
@@ -21,46 +303,135 @@ class AttentionGNN(torch.nn.Module):
 			out_dim = 112,
 			num_layers = 3,
 			dropout = 0.25,
+			attn_heads = 1,
+			head_merge = 'concat',
+			checkpoint_block = 0,
+			edge_space = True,
 		):
+		'''
+		params:
+			- attention_type: attention layer, 'self' or 'label_embed' (LabelEmbeddingAttentionLayer), 'feature',
+			  'label_injection' or 'linear' (kernelised attention, see LinearAttentionLayer)
+			- attn_heads: number of attention heads in every layer
+			- head_merge: how the heads of a layer are merged, 'concat' splits hid_dim and out_dim between the heads (so the
+			  number of parameters barely depends on attn_heads), 'mean' gives every head hid_dim (or out_dim) dimensions
+			  and averages them
+			- checkpoint_block: number of consecutive layers whose activations (the per-edge messages) are recomputed
+			  together in the backward pass rather than stored, 0 to store every activation
+			- edge_space: score queries against edges in the edge feature space (see EdgeLinear.score), turn off to
+			  project every edge instead, which can be cached across evaluation passes with set_edge_cache
+		'''
 		super(AttentionGNN, self).__init__()
 
 		# create a parameter dictionary to store information about the model, used for logging experiments
 		self.param_dict = {'model_type':'ATTN_' + attention_type, 'propagation':propagation, 'in_dim':in_dim, 'hid_dim':hid_dim, 'out_dim':out_dim, 'layers':num_layers,
-							'dropout':dropout}
+							'dropout':dropout, 'heads':attn_heads, 'head_merge':head_merge, 'checkpoint':checkpoint_block, 'edge_space':edge_space}
+
+		# dimension of each head, so that merged heads have hid_dim (or out_dim) dimensions
+		if head_merge == 'concat':
+			if hid_dim % attn_heads != 0 or out_dim % attn_heads != 0:
+				raise Exception('AttentionGNN: hid_dim and out_dim must be divisible by attn_heads to concatenate heads')
+			hid_head_dim, out_head_dim = hid_dim // attn_heads, out_dim // attn_heads
+		elif head_merge == 'mean':
+			hid_head_dim, out_head_dim = hid_dim, out_dim
+		else:
+			raise Exception('AttentionGNN head merge "' + head_merge + '" not recognized')
+		concat = head_merge == 'concat'
+
+		# set the attention layer type to use in the model
+		if attention_type in ['self', 'label_embed']:
+			attn_layer = LabelEmbeddingAttentionLayer
+		elif attention_type == 'feature':
+			attn_layer = FeatureAttentionLayer
+		elif attention_type == 'label_injection':
+			attn_layer = LabelInjectionAttentionLayer
+		elif attention_type == 'linear':
+			attn_layer = LinearAttentionLayer
+		else:
+			raise Exception('AttentionGNN attention type "' + attention_type + '" not recognized')
 
 		# construct layers	
-		attn_layer = LabelEmbeddingAttentionLayer #LabelFeatureAttentionLayer
 		
 		self.layers = torch.nn.ModuleList()
 		self.layers.append(
-			attn_layer(in_dim=in_dim, out_dim=hid_dim)
+			attn_layer(in_dim=in_dim, out_dim=hid_head_dim, attn_heads=attn_heads, concat=concat, edge_space=edge_space)
 		)
 
 		for _ in range(num_layers - 2):
 			self.layers.append(
-				attn_layer(in_dim=hid_dim, out_dim=hid_dim)
+				attn_layer(in_dim=hid_dim, out_dim=hid_head_dim, attn_heads=attn_heads, concat=concat, edge_space=edge_space)
 			)
 
 		self.layers.append(
-			attn_layer(in_dim=hid_dim, out_dim=out_dim)
+			attn_layer(in_dim=hid_dim, out_dim=out_head_dim, attn_heads=attn_heads, concat=concat, edge_space=edge_space)
 		)
 
 		self.dropout = dropout
+		self.checkpoint_block = checkpoint_block
 
 	def reset_parameters(self):
 		for layer in self.layers:
 			layer.reset_parameters()
 
-	def forward(self, batch):
-		for layer in self.layers[:-1]:
-			batch.x = layer(batch)
-			batch.x = F.relu(batch.x)
-			batch.x = F.dropout(batch.x, p=self.dropout, training=self.training)
-		batch.x = self.layers[-1](batch)
+	def set_edge_cache(self, cache):
+		'''
+		share an EdgeProjectionCache (or None to stop caching) between the edge projections of every layer, projections
+		are only computed per edge when the model is created with edge_space off
+		'''
+		for layer in self.layers:
+			layer.lin_key_edge.cache = cache
+
+	def set_attention_engine(self, engine):
+		'''
+		run the neighbourhood softmax attention of every layer which has one with engine (a BucketedAttention), or with
+		propagate if None. The label embedding layers attend over label keys per edge and always use propagate
+		'''
+		for layer in self.layers:
+			if hasattr(layer, 'engine'):
+				layer.engine = engine
+
+	def input_features(self, batch):
+		'''
+		returns:
+			input of the first layer for every node in the batch
+		'''
 		return batch.x
 
+	def layer_forward(self, i, x, batch):
+		'''
+		apply layer i (and its activation if it is not the last layer) to the node representations x of a batch
+		'''
+		x = self.layers[i](x, batch)
+		if i < len(self.layers) - 1:
+			x = F.relu(x)
+			x = F.dropout(x, p=self.dropout, training=self.training)
+		return x
+
+	def block_forward(self, start, x, batch):
+		'''
+		apply the checkpoint_block layers from layer start to the node representations x of a batch
+		'''
+		for i in range(start, min(start + self.checkpoint_block, len(self.layers))):
+			x = self.layer_forward(i, x, batch)
+		return x
+
+	def forward(self, batch):
+		x = self.input_features(batch)
+
+		# only the inputs of each block are kept for the backward pass, the block's messages are recomputed from them
+		if self.checkpoint_block > 0 and self.training and torch.is_grad_enabled():
+			for start in range(0, len(self.layers), self.checkpoint_block):
+				x = checkpoint(self.block_forward, start, x, batch, use_reentrant=False)
+			return x
+
+		for i in range(len(self.layers)):
+			x = self.layer_forward(i, x, batch)
+		return x
+
 
 class FeatureAttentionLayer(MessagePassing):
+	# dense execution of the attention, see BucketedAttention
+	engine: Optional[BucketedAttention] = None
 
 	def __init__(
 		self,
@@ -70,24 +441,26 @@ class FeatureAttentionLayer(MessagePassing):
 		attn_heads: int = 1,
 		dropout: float = 0.1,
 		edge_dim: int = 8,
+		edge_space: bool = True,
+		concat: bool = True,
 		**kwargs,
 	):
 		kwargs.setdefault('aggr', 'add')
-		super(AttentionLayer, self).__init__(node_dim=0, **kwargs)
+		super(FeatureAttentionLayer, self).__init__(node_dim=0, **kwargs)
 
 		self.in_dim = in_dim
 		self.out_dim = out_dim
 		self.heads = attn_heads
 		self.dropout = dropout
 		self.edge_dim = edge_dim
-		self.label_dim = label_dim
-		self.label_emb_dim = label_emb_dim
+		self.edge_space = edge_space
+		self.concat = concat
 
 		self.lin_query = Linear(in_dim, attn_heads * out_dim)
-		self.lin_key_edge = Linear(edge_dim, attn_heads * out_dim)
+		self.lin_key_edge = EdgeLinear(edge_dim, attn_heads * out_dim)
 		self.lin_key_node = Linear(in_dim, attn_heads * out_dim)
 		self.lin_value = Linear(in_dim, attn_heads * out_dim)
-		self.lin_skip = Linear(in_dim, attn_heads * out_dim, bias=True)
+		self.lin_skip = Linear(in_dim, attn_heads * out_dim if concat else out_dim, bias=True)
 
 		self.reset_parameters()
 
@@ -99,26 +472,32 @@ class FeatureAttentionLayer(MessagePassing):
 		self.lin_skip.reset_parameters()
 
 
-	def forward(self, batch):
+	def forward(self, x: Tensor, batch):
 		H, C = self.heads, self.out_dim
 
-		feat_q = self.lin_query(batch.x).view(-1, H, C)
-		feat_v = self.lin_value(batch.x).view(-1, H, C)
-		feat_k = self.lin_key_node(batch.x).view(-1, H, C)
-	
-		# propagate_type: (query: Tensor, key:Tensor, value: Tensor, edge_attr: OptTensor) # noqa
-		x = self.propagate(
-				batch.edge_index,
-				feat_q=feat_q,
-				feat_v=feat_v,
-				feat_k=feat_k,
-				edge_attr=batch.edge_attr,
-				size=None,
-			)
+		feat_q = self.lin_query(x).view(-1, H, C)
+		feat_v = self.lin_value(x).view(-1, H, C)
+		feat_k = self.lin_key_node(x).view(-1, H, C)
+		x_skip = self.lin_skip(x)
 
-		x = x.view(-1, self.heads * self.out_dim)
-
-		x_skip = self.lin_skip(batch.x)
+		# scores of the queries against the edge keys, computed in the edge feature space unless edge_space is off
+		edge_score = self.lin_key_edge.score(feat_q, batch.edge_attr, batch.edge_index[1], self.edge_space, getattr(batch, 'e_id', None))
+	
+		if self.engine is not None:
+			x = self.engine(feat_q, feat_k, feat_v, edge_score, batch.edge_index, self.dropout, self.training)
+		else:
+			# propagate_type: (feat_q: Tensor, feat_v: Tensor, feat_k: Tensor, edge_score: Tensor) # noqa
+			x = self.propagate(
+					batch.edge_index,
+					feat_q=feat_q,
+					feat_v=feat_v,
+					feat_k=feat_k,
+					edge_score=edge_score,
+					size=None,
+				)
+
+		# merge the heads
+		x = x.view(-1, self.heads * self.out_dim) if self.concat else x.mean(dim=1)
 
 		x += x_skip
 
@@ -129,26 +508,23 @@ class FeatureAttentionLayer(MessagePassing):
 			feat_q_i: Tensor,
 			feat_v_j: Tensor,
 			feat_k_j: Tensor,
-			edge_attr: Tensor,
+			edge_score: Tensor,
 			index: Tensor,
 			ptr: OptTensor,
 			size_i: Optional[int],
 			) -> Tensor:
 
-		edge_k = self.lin_key_edge(edge_attr).view(-1, self.heads, self.out_dim)
-
-		m = self.feature_attention(q=feat_q_i, k=feat_k_j, v=feat_v_j, e=edge_k, index=index)
+		m = self.feature_attention(q=feat_q_i, k=feat_k_j, v=feat_v_j, e=edge_score, index=index, num_nodes=size_i)
 
 		return m
 
-	def feature_attention(self, q, k, v, e, index):
-		# calculate raw attention scores
-		x = q * (e + k)
-		x = x.sum(dim=-1)
+	def feature_attention(self, q, k, v, e, index, num_nodes=None):
+		# calculate raw attention scores, e holds the [num_edges, heads] scores of the queries against the edge keys
+		x = (q * k).sum(dim=-1) + e
 		x = x / math.sqrt(self.out_dim)
 
-		# normalise attention scores using softmax
-		alpha = softmax(x, index)
+		# normalise attention scores using softmax, num_nodes is passed so that it is not found from index.max()
+		alpha = softmax(x, index, num_nodes=num_nodes)
 		alpha = F.dropout(alpha, p=self.dropout, training=self.training)
 
 		# apply weighted score to neighbour values
@@ -158,6 +534,8 @@ class FeatureAttentionLayer(MessagePassing):
 
 
 class LabelInjectionAttentionLayer(MessagePassing):
+	# dense execution of the attention, see BucketedAttention
+	engine: Optional[BucketedAttention] = None
 
 	def __init__(
 		self,
@@ -170,6 +548,8 @@ class LabelInjectionAttentionLayer(MessagePassing):
 		edge_dim: int = 8,
 		label_dim: int = 112,
 		label_k_dim: int = 8,
+		edge_space: bool = True,
+		concat: bool = True,
 		**kwargs,
 	):
 		kwargs.setdefault('aggr', 'add')
@@ -181,13 +561,15 @@ class LabelInjectionAttentionLayer(MessagePassing):
 		self.dropout = dropout
 		self.edge_dim = edge_dim
 		self.label_dim = label_dim
+		self.edge_space = edge_space
+		self.concat = concat
 
 		# feature layers
 		self.lin_query = Linear(in_dim, attn_heads * out_dim)
-		self.lin_key_edge = Linear(edge_dim, attn_heads * out_dim)
+		self.lin_key_edge = EdgeLinear(edge_dim, attn_heads * out_dim)
 		self.lin_key_node = Linear(in_dim, attn_heads * out_dim)
 		self.lin_value = Linear(in_dim, attn_heads * out_dim)
-		self.lin_skip = Linear(in_dim, attn_heads * out_dim, bias=True)
+		self.lin_skip = Linear(in_dim, attn_heads * out_dim if concat else out_dim, bias=True)
 
 		# label layers
 		self.lin_label = Linear(self.label_dim, in_dim, bias=False)
@@ -201,11 +583,9 @@ class LabelInjectionAttentionLayer(MessagePassing):
 		self.lin_skip.reset_parameters()
 
 
-	def forward(self, batch):
+	def forward(self, x: Tensor, batch):
 		H, C = self.heads, self.out_dim
 
-		x = batch.x
-
 		if self.training:
 			known_y = batch.train_masked_y	
 		else:
@@ -215,23 +595,29 @@ class LabelInjectionAttentionLayer(MessagePassing):
 
 		#x = x + label
 		
-		feat_q = self.lin_query(batch.x).view(-1, H, C)
-		feat_v = self.lin_value(batch.x).view(-1, H, C)
-		feat_k = self.lin_key_node(batch.x).view(-1, H, C)
-	
-		# propagate_type: (query: Tensor, key:Tensor, value: Tensor, edge_attr: OptTensor) # noqa
-		x = self.propagate(
-				batch.edge_index,
-				feat_q=feat_q,
-				feat_v=feat_v,
-				feat_k=feat_k,
-				edge_attr=batch.edge_attr,
-				size=None,
-			)
+		feat_q = self.lin_query(x).view(-1, H, C)
+		feat_v = self.lin_value(x).view(-1, H, C)
+		feat_k = self.lin_key_node(x).view(-1, H, C)
+		x_skip = self.lin_skip(x)
 
-		x = x.view(-1, self.heads * self.out_dim)
-
-		x_skip = self.lin_skip(batch.x)
+		# scores of the queries against the edge keys, computed in the edge feature space unless edge_space is off
+		edge_score = self.lin_key_edge.score(feat_q, batch.edge_attr, batch.edge_index[1], self.edge_space, getattr(batch, 'e_id', None))
+	
+		if self.engine is not None:
+			x = self.engine(feat_q, feat_k, feat_v, edge_score, batch.edge_index, self.dropout, self.training)
+		else:
+			# propagate_type: (feat_q: Tensor, feat_v: Tensor, feat_k: Tensor, edge_score: Tensor) # noqa
+			x = self.propagate(
+					batch.edge_index,
+					feat_q=feat_q,
+					feat_v=feat_v,
+					feat_k=feat_k,
+					edge_score=edge_score,
+					size=None,
+				)
+
+		# merge the heads
+		x = x.view(-1, self.heads * self.out_dim) if self.concat else x.mean(dim=1)
 
 		x += x_skip
 
@@ -242,26 +628,23 @@ class LabelInjectionAttentionLayer(MessagePassing):
 			feat_q_i: Tensor,
 			feat_v_j: Tensor,
 			feat_k_j: Tensor,
-			edge_attr: Tensor,
+			edge_score: Tensor,
 			index: Tensor,
 			ptr: OptTensor,
 			size_i: Optional[int],
 			) -> Tensor:
 
-		edge_k = self.lin_key_edge(edge_attr).view(-1, self.heads, self.out_dim)
-
-		m = self.self_attention(q=feat_q_i, k=feat_k_j, v=feat_v_j, e=edge_k, index=index)
+		m = self.self_attention(q=feat_q_i, k=feat_k_j, v=feat_v_j, e=edge_score, index=index, num_nodes=size_i)
 
 		return m
 
-	def self_attention(self, q, k, v, e, index):
-		# calculate raw attention scores
-		x = q * (e + k)
-		x = x.sum(dim=-1)
+	def self_attention(self, q, k, v, e, index, num_nodes=None):
+		# calculate raw attention scores, e holds the [num_edges, heads] scores of the queries against the edge keys
+		x = (q * k).sum(dim=-1) + e
 		x = x / math.sqrt(self.out_dim)
 
-		# normalise attention scores using softmax
-		alpha = softmax(x, index)
+		# normalise attention scores using softmax, num_nodes is passed so that it is not found from index.max()
+		alpha = softmax(x, index, num_nodes=num_nodes)
 		alpha = F.dropout(alpha, p=self.dropout, training=self.training)
 
 		# apply weighted score to neighbour values
@@ -270,8 +653,8 @@ class LabelInjectionAttentionLayer(MessagePassing):
 		return x
 
 	def __repr__(self) -> str:
-		return (f'{self.__class__.__name__}({self.in_channels}, '
-				f'{self.out_channels}, heads={self.heads})')
+		return (f'{self.__class__.__name__}({self.in_dim}, '
+				f'{self.out_dim}, heads={self.heads})')
 
 
 class LabelEmbeddingAttentionLayer(MessagePassing):
@@ -288,6 +671,8 @@ class LabelEmbeddingAttentionLayer(MessagePassing):
 		label_dim: int = 112,
 		label_emb_dim: int = 8,
 		label_k: int = 4,
+		edge_space: bool = True,
+		concat: bool = True,
 		**kwargs,
 	):
 		kwargs.setdefault('aggr', 'add')
@@ -299,14 +684,16 @@ class LabelEmbeddingAttentionLayer(MessagePassing):
 		self.dropout = dropout
 		self.edge_dim = edge_dim
 		self.label_dim = label_dim
+		self.edge_space = edge_space
+		self.concat = concat
 		self.label_k = label_k
 
 		# feature layers
 		self.lin_query = Linear(in_dim, attn_heads * out_dim)
-		self.lin_key_edge = Linear(edge_dim, attn_heads * out_dim)
+		self.lin_key_edge = EdgeLinear(edge_dim, attn_heads * out_dim)
 		self.lin_key_node = Linear(in_dim, attn_heads * out_dim)
 		self.lin_value = Linear(in_dim, attn_heads * out_dim)
-		self.lin_skip = Linear(in_dim, attn_heads * out_dim, bias=True)
+		self.lin_skip = Linear(in_dim, attn_heads * out_dim if concat else out_dim, bias=True)
 
 		# label layers
 		self.lin_label = Linear(self.label_dim, in_dim, bias=False)
@@ -315,7 +702,7 @@ class LabelEmbeddingAttentionLayer(MessagePassing):
 		torch.nn.init.xavier_uniform(self.emb_label)
 		self.lin_label_to_k = Linear(self.label_dim, label_k)
 		self.lin_k_to_out = Linear(label_k, out_dim)
-		self.label_softmax = torch.nn.Softmax(dim=1)
+		self.label_softmax = torch.nn.Softmax(dim=-1)
 
 		self.reset_parameters()
 
@@ -326,11 +713,9 @@ class LabelEmbeddingAttentionLayer(MessagePassing):
 		self.lin_skip.reset_parameters()
 
 
-	def forward(self, batch):
+	def forward(self, x: Tensor, batch):
 		H, C = self.heads, self.out_dim
 
-		x = batch.x
-
 		if self.training:
 			known_y = batch.train_masked_y	
 		else:
@@ -340,24 +725,30 @@ class LabelEmbeddingAttentionLayer(MessagePassing):
 
 		#x = x + label
 		
-		feat_q = self.lin_query(batch.x).view(-1, H, C)
-		feat_v = self.lin_value(batch.x).view(-1, H, C)
-		feat_k = self.lin_key_node(batch.x).view(-1, H, C)
+		feat_q = self.lin_query(x).view(-1, H, C)
+		feat_v = self.lin_value(x).view(-1, H, C)
+		feat_k = self.lin_key_node(x).view(-1, H, C)
+		x_skip = self.lin_skip(x)
+
+		# scores of the queries against the edge keys, computed in the edge feature space unless edge_space is off
+		edge_score = self.lin_key_edge.score(feat_q, batch.edge_attr, batch.edge_index[1], self.edge_space, getattr(batch, 'e_id', None))
+
+		# label keys depend only on a node's labels, so they are computed per node and gathered per edge
+		label_key = self.label_keys(known_y)
 	
-		# propagate_type: (query: Tensor, key:Tensor, value: Tensor, edge_attr: OptTensor) # noqa
+		# propagate_type: (feat_q: Tensor, feat_v: Tensor, feat_k: Tensor, edge_score: Tensor, label_key: Tensor) # noqa
 		x = self.propagate(
 				batch.edge_index,
 				feat_q=feat_q,
 				feat_v=feat_v,
 				feat_k=feat_k,
-				edge_attr=batch.edge_attr,
-				label = known_y,
+				edge_score=edge_score,
+				label_key=label_key,
 				size=None,
 			)
 
-		x = x.view(-1, self.heads * self.out_dim)
-
-		x_skip = self.lin_skip(batch.x)
+		# merge the heads
+		x = x.view(-1, self.heads * self.out_dim) if self.concat else x.mean(dim=1)
 
 		x += x_skip
 
@@ -368,61 +759,160 @@ class LabelEmbeddingAttentionLayer(MessagePassing):
 			feat_q_i: Tensor,
 			feat_v_j: Tensor,
 			feat_k_j: Tensor,
-			edge_attr: Tensor,
-			label_j: Tensor,
+			edge_score: Tensor,
+			label_key_j: Tensor,
 			index: Tensor,
 			ptr: OptTensor,
 			size_i: Optional[int],
 			) -> Tensor:
 
-		edge_k = self.lin_key_edge(edge_attr).view(-1, self.heads, self.out_dim)
-
-		f = self.self_attention(q=feat_q_i, k=feat_k_j, v=feat_v_j, e=edge_k, index=index)
-		l = self.label_attention(q=feat_q_i, l=label_j, e=edge_k, index=index) 
-#		print('f:\n',f[0])
-#		print('l:\n',l[0])
-#		print('emb:\n',self.emb_label)
-#		print('\n\n')
+		# only the label attention is used as the message, so the feature attention (self_attention) is not computed
+		l = self.label_attention(q=feat_q_i, k_labels=label_key_j, e=edge_score, index=index)
 
 		return l
 
-	def self_attention(self, q, k, v, e, index):
-		# calculate raw attention scores
-		x = q * (e + k)
-		x = x.sum(dim=-1)
+	def self_attention(self, q, k, v, e, index, num_nodes=None):
+		# calculate raw attention scores, e holds the [num_edges, heads] scores of the queries against the edge keys
+		x = (q * k).sum(dim=-1) + e
 		x = x / math.sqrt(self.out_dim)
 
-		# normalise attention scores using softmax
-		alpha = softmax(x, index)
+		# normalise attention scores using softmax, num_nodes is passed so that it is not found from index.max()
+		alpha = softmax(x, index, num_nodes=num_nodes)
 		alpha = F.dropout(alpha, p=self.dropout, training=self.training)
 
 		# apply weighted score to neighbour values
 		x = v * alpha.view(-1, self.heads, 1)
 		return x
 
-	def label_attention(self, q, l, e, index):
-		# multiply label by embedding matrix (acts as a mask)
-		embedded_labels = l.unsqueeze(-1) * self.emb_label
-		embedded_labels = embedded_labels
-
-		# project sequence dimension to k
-		k_labels = self.lin_label_to_k(embedded_labels.permute(0,2,1)).permute(0,2,1)
-
-		# self-attention
-		q = q.repeat(1, self.label_k, 1)
-		x = q * (e + k_labels)
-		x = x.sum(dim=-1)
+	def label_keys(self, label):
+		'''
+		label keys of each node, the label embedding matrix masked by the node's labels (label[:, None] * emb_label) with
+		its label dimension projected to label_k. Both steps are linear in the labels so they are factorised into one
+		[label_dim, label_k * out_dim] weight, K = einsum('nl,kl,lc->nkc', label, lin_label_to_k.weight, emb_label), and
+		the [num_nodes, label_dim, out_dim] masked embedding is never built
+		params:
+			- label: [num_nodes, label_dim] observed labels
+		returns:
+			[num_nodes, label_k, out_dim] tensor of label keys
+		'''
+		weight = self.lin_label_to_k.weight.t().unsqueeze(-1) * self.emb_label.unsqueeze(1)
+		keys = torch.matmul(label.to(weight.dtype), weight.reshape(self.label_dim, -1)).view(-1, self.label_k, self.out_dim)
+		if self.lin_label_to_k.bias is not None:
+			keys = keys + self.lin_label_to_k.bias.view(1, -1, 1)
+		return keys
+
+	def label_attention(self, q, k_labels, e, index):
+		# self-attention of every head over the label keys of the source node (see label_keys), as one batched
+		# [num_edges, heads, label_k] product of the [num_edges, heads, out_dim] queries and [num_edges, label_k, out_dim] keys
+		x = torch.matmul(q, k_labels.transpose(1, 2)) + e.unsqueeze(-1)
 		x = x / math.sqrt(self.label_k)
 
 		alpha = self.label_softmax(x)
 		alpha = F.dropout(alpha, p=self.dropout, training=self.training)
 
 		x = x * alpha
-		x = self.lin_k_to_out(x).unsqueeze(1) 
+		x = self.lin_k_to_out(x)
 		
 		return x	
 		
 
 	def __repr__(self) -> str:
-		return (f'{self.__class__.__name__}({self.in_channels}, '
-				f'{self.out_channels}, heads={self.heads})')
+		return (f'{self.__class__.__name__}({self.in_dim}, '
+				f'{self.out_dim}, heads={self.heads})')
+
+
+class LinearAttentionLayer(MessagePassing):
+	'''
+	Neighbourhood attention with a kernel feature map in place of the softmax, the weight of edge j -> i is
+	phi(q_i) . phi(k_j) + phi(e_ij) with phi(x) = elu(x) + 1, which is positive so it needs no normalising maximum. Each
+	edge sends [w_ij * v_j, w_ij] and one scatter of the [num_edges, heads, out_dim + 1] messages gives every target both
+	the weighted sum of its values and the normaliser, where the softmax needs separate scatters for the maximum, the sum
+	and the aggregation. The values carry a column of ones so that the messages are a single product w_ij * [v_j, 1].
+	'''
+	def __init__(
+		self,
+		in_dim: int,
+		out_dim: int,
+		attn_heads: int = 1,
+		dropout: float = 0.1,
+		edge_dim: int = 8,
+		edge_space: bool = True,
+		concat: bool = True,
+		eps: float = 1e-6,
+		**kwargs,
+	):
+		kwargs.setdefault('aggr', 'add')
+		super(LinearAttentionLayer, self).__init__(node_dim=0, **kwargs)
+
+		self.in_dim = in_dim
+		self.out_dim = out_dim
+		self.heads = attn_heads
+		self.dropout = dropout
+		self.edge_dim = edge_dim
+		self.edge_space = edge_space
+		self.concat = concat
+		self.eps = eps
+
+		self.lin_query = Linear(in_dim, attn_heads * out_dim)
+		self.lin_key_edge = EdgeLinear(edge_dim, attn_heads * out_dim)
+		self.lin_key_node = Linear(in_dim, attn_heads * out_dim)
+		self.lin_value = Linear(in_dim, attn_heads * out_dim)
+		self.lin_skip = Linear(in_dim, attn_heads * out_dim if concat else out_dim, bias=True)
+
+		self.reset_parameters()
+
+	def reset_parameters(self):
+		self.lin_query.reset_parameters()
+		self.lin_key_edge.reset_parameters()
+		self.lin_key_node.reset_parameters()
+		self.lin_value.reset_parameters()
+		self.lin_skip.reset_parameters()
+
+	def forward(self, x: Tensor, batch):
+		H, C = self.heads, self.out_dim
+
+		feat_q = self.lin_query(x).view(-1, H, C)
+		feat_v = F.pad(self.lin_value(x).view(-1, H, C), (0, 1), value=1.)
+		feat_k = self.lin_key_node(x).view(-1, H, C)
+		x_skip = self.lin_skip(x)
+
+		# scores of the queries against the edge keys, computed in the edge feature space unless edge_space is off
+		edge_score = self.lin_key_edge.score(feat_q, batch.edge_attr, batch.edge_index[1], self.edge_space, getattr(batch, 'e_id', None))
+
+		# propagate_type: (feat_q: Tensor, feat_v: Tensor, feat_k: Tensor, edge_score: Tensor) # noqa
+		x = self.propagate(
+				batch.edge_index,
+				feat_q=F.elu(feat_q) + 1,
+				feat_v=feat_v,
+				feat_k=F.elu(feat_k) + 1,
+				edge_score=edge_score,
+				size=None,
+			)
+
+		# normalise the weighted values by the summed weights
+		x = x[..., :C] / (x[..., C:] + self.eps)
+
+		# merge the heads
+		x = x.view(-1, self.heads * self.out_dim) if self.concat else x.mean(dim=1)
+
+		x += x_skip
+
+		return x
+
+	def message(
+			self,
+			feat_q_i: Tensor,
+			feat_v_j: Tensor,
+			feat_k_j: Tensor,
+			edge_score: Tensor,
+			) -> Tensor:
+
+		# feat_q and feat_k are already mapped by phi
+		w = (feat_q_i * feat_k_j).sum(dim=-1) / math.sqrt(self.out_dim) + F.elu(edge_score / math.sqrt(self.out_dim)) + 1
+		w = F.dropout(w, p=self.dropout, training=self.training)
+
+		return feat_v_j * w.unsqueeze(-1)
+
+	def __repr__(self) -> str:
+		return (f'{self.__class__.__name__}({self.in_dim}, '
+				f'{self.out_dim}, heads={self.heads})')
@@ -4,6 +4,7 @@ from data import get_graph_data
 from models.mlp import MLP
 from models.gnn import GNN
 from models.transformers import AttentionGNN
+from models.label_prop import LabelPropagation
 from training import GraphTrainer
 from logger import Logger
 
@@ -32,7 +33,7 @@ torch.manual_seed(0)
 
 graph, split_idx = get_graph_data()
 
-trainer = GraphTrainer(graph, split_idx, train_batch_size=32, sampler_num_neighbours=100, label_mask_p=0.8)#0.126)
+trainer = GraphTrainer(graph, split_idx, train_batch_size=32, sampler_num_neighbours=100, label_mask_p=0.8, cache_dir=config.cache_path)#0.126)
 #trainer.normalise()
 criterion = torch.nn.BCEWithLogitsLoss()
 
@@ -52,7 +53,8 @@ logs = trainer.train(model.to(config.device), criterion, num_epochs=100, lr=0.00
 # gcn = GNN(conv_type='GCN', in_dim=trainer.graph.x.size(-1), hid_dim=64, out_dim=112, num_layers=1, dropout=0.1)
 # sage = GNN(conv_type='SAGE', in_dim=trainer.graph.x.size(-1), hid_dim=64, out_dim=112, num_layers=1, dropout=0.1)
 # gat = GNN(conv_type='GAT', in_dim=trainer.graph.x.size(-1), hid_dim=64, out_dim=112, num_layers=1, dropout=0.1)
+# lp = LabelPropagation(num_layers=50, alpha=0.9, edge_weight='mean')
 
-# models = [mlp, gcn, sage, gat]
+# models = [lp, mlp, gcn, sage, gat]
 
 # trainer.run_experiment(models)
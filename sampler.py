@@ -0,0 +1,619 @@
+import time
+import queue
+import threading
+import torch
+from torch_geometric.data import Data
+from data import gather_csr, unpack_labels
+
+# node attributes gathered into batches, those the graph does not have (e.g. train_masked_y with a LabelMask) are skipped
+# packed labels (y_packed and label_flags, see data.pack_labels) are unpacked once gathered
+NODE_KEYS = ['x', 'y', 'train_masked_y', 'eval_masked_y', 'y_packed', 'label_flags']
+
+
+def collate(graph, n_id, edge_index, e_id, batch_size):
+	'''
+	build a batch in the layout produced by NeighborLoader, i.e. the first batch_size nodes are the target nodes
+	params:
+		- graph: graph to gather node and edge attributes from
+		- n_id: global index of each node in the batch
+		- edge_index: [2, num_batch_edges] edges between local node indexes
+		- e_id: index of each batch edge in graph.edge_index
+		- batch_size: number of target nodes
+	returns:
+		Data object of the batch
+	'''
+	batch = Data(
+			edge_index=edge_index,
+			edge_attr=graph.edge_attr[e_id],
+			n_id=n_id,
+			e_id=e_id,
+			num_nodes=n_id.numel(),
+		)
+	for key in NODE_KEYS:
+		if key in graph:
+			batch[key] = graph[key][n_id]
+	batch.batch_size = batch_size
+
+	if 'y_packed' in batch:
+		unpack_labels(batch)
+	return batch
+
+
+def sample_neighbours(csr, seeds, fanout, generator=None):
+	'''
+	sample fanout incoming neighbours of each seed node uniformly with replacement, in one vectorised call
+	params:
+		- csr: CSR adjacency of the graph
+		- seeds: tensor of node indexes
+		- fanout: number of neighbours to sample per node
+		- generator (optional): random generator to sample with
+	returns:
+		[num_seeds, fanout] tensor of CSR positions of the sampled edges, -1 for nodes without neighbours
+	'''
+	start = csr.indptr[seeds]
+	deg = csr.indptr[seeds + 1] - start
+
+	# scale uniform samples by the degree of each node to get offsets into its neighbour slice
+	offsets = torch.rand(seeds.numel(), fanout, generator=generator).mul_(deg.unsqueeze(-1)).long()
+	pos = offsets.add_(start.unsqueeze(-1))
+
+	return pos.masked_fill_(deg.eq(0).unsqueeze(-1), -1)
+
+
+def one_hop_batch(graph, csr, seeds, pos):
+	'''
+	build a batch of seed nodes and a fixed number of sampled incoming edges per seed, each sampled edge gets its own
+	source node so the batch is built from index gathers alone
+	params:
+		- graph: graph to gather node and edge attributes from
+		- csr: CSR adjacency of the graph
+		- seeds: tensor of target node indexes
+		- pos: [num_seeds, fanout] tensor of CSR positions of the sampled edges, -1 entries are skipped
+	returns:
+		Data object of the batch
+	'''
+	batch_size, fanout = pos.shape
+	target = torch.arange(batch_size).repeat_interleave(fanout)
+	pos = pos.view(-1)
+
+	# drop the padding of nodes without neighbours
+	valid = pos.ge(0)
+	if not bool(valid.all()):
+		pos, target = pos[valid], target[valid]
+
+	n_id = torch.cat([seeds, csr.indices[pos]])
+	source = torch.arange(batch_size, n_id.numel())
+	e_id = pos if csr.perm is None else csr.perm[pos]
+
+	return collate(graph, n_id, torch.stack([source, target]), e_id, batch_size)
+
+
+def full_neighbour_batch(graph, csr, seeds):
+	'''
+	build a batch of seed nodes and all of their incoming edges, each edge gets its own source node
+	params:
+		- graph: graph to gather node and edge attributes from
+		- csr: CSR adjacency of the graph
+		- seeds: tensor of target node indexes
+	returns:
+		Data object of the batch
+	'''
+	ptr, pos = gather_csr(csr.indptr, seeds)
+
+	n_id = torch.cat([seeds, csr.indices[pos]])
+	source = torch.arange(seeds.numel(), n_id.numel())
+	target = torch.repeat_interleave(torch.arange(seeds.numel()), ptr.diff())
+	e_id = pos if csr.perm is None else csr.perm[pos]
+
+	return collate(graph, n_id, torch.stack([source, target]), e_id, seeds.numel())
+
+
+def chunk_by_edges(csr, nodes, max_edges):
+	'''
+	split nodes into consecutive chunks whose total in-degree is at most max_edges, a node with more edges gets its own chunk
+	returns:
+		list of node index tensors
+	'''
+	cum_deg = torch.cumsum(csr.indptr[nodes + 1] - csr.indptr[nodes], dim=0)
+
+	chunks, start = [], 0
+	while start < nodes.numel():
+		offset = int(cum_deg[start - 1]) if start > 0 else 0
+		end = max(int(torch.searchsorted(cum_deg, offset + max_edges, right=True)), start + 1)
+		chunks.append(nodes[start:end])
+		start = end
+	return chunks
+
+
+def induced_subgraph(csr, n_id, local=None):
+	'''
+	find all edges between a set of nodes
+	params:
+		- csr: CSR adjacency of the graph
+		- n_id: global index of each node in the subgraph
+		- local (optional): [num_nodes] buffer filled with -1, reused between calls to avoid reallocating
+	returns:
+		edge_index between local node indexes and the index of each edge in graph.edge_index
+	'''
+	if local is None:
+		local = torch.full((csr.indptr.numel() - 1,), -1, dtype=torch.long)
+	local[n_id] = torch.arange(n_id.numel())
+
+	# incoming edges of every node, kept if their source is also in the subgraph
+	ptr, pos = gather_csr(csr.indptr, n_id)
+	source = local[csr.indices[pos]]
+	target = torch.repeat_interleave(torch.arange(n_id.numel()), ptr.diff())
+	keep = source.ge(0)
+
+	local[n_id] = -1
+
+	pos = pos[keep]
+	e_id = pos if csr.perm is None else csr.perm[pos]
+	return torch.stack([source[keep], target[keep]]), e_id
+
+
+def grow_partitions(csr, partition, node_order, part_size, first_part=0):
+	'''
+	grow partitions of part_size nodes breadth first, each from the next unassigned node of node_order
+	params:
+		- csr: CSR adjacency of the graph
+		- partition: [num_nodes] tensor of partition indexes, -1 for unassigned nodes, filled in place
+		- node_order: order in which nodes are used as seeds, every node of it is assigned
+		- part_size: number of nodes in each partition
+		- first_part: index of the first partition grown
+	returns:
+		index of the partition after the last one grown
+	'''
+	next_seed, part, size = 0, first_part, 0
+	frontier = node_order[:0]
+
+	while next_seed < node_order.numel():
+		# when the frontier is exhausted continue the partition from the next unassigned node
+		if frontier.numel() == 0:
+			if partition[node_order[next_seed]] >= 0:
+				next_seed += 1
+				continue
+			frontier = node_order[next_seed:next_seed + 1]
+			partition[frontier] = part
+			size += 1
+
+		# expand one level at a time until the partition is full
+		_, pos = gather_csr(csr.indptr, frontier)
+		neighbours = torch.unique(csr.indices[pos])
+		neighbours = neighbours[partition[neighbours].lt(0)][:part_size - size]
+		partition[neighbours] = part
+		size += neighbours.numel()
+		frontier = neighbours
+
+		if size >= part_size:
+			part, size = part + 1, 0
+			frontier = node_order[:0]
+
+	return part + (size > 0)
+
+
+def partition_graph(graph, csr, num_parts, method='bfs', seed=0):
+	'''
+	assign every node to one of num_parts partitions
+	params:
+		- graph: graph to partition
+		- csr: CSR adjacency of the graph
+		- num_parts: number of partitions
+		- method: 'bfs' grows each partition breadth first from a random seed node, keeping neighbourhoods together.
+		  'species' gives each species (edges only connect proteins of the same species) a number of partitions
+		  proportional to its size and grows them breadth first within the species, so no partition mixes species
+		- seed: random seed
+	returns:
+		[num_nodes] tensor of partition indexes
+	'''
+	num_nodes = graph.num_nodes
+	generator = torch.Generator().manual_seed(seed)
+	partition = torch.full((num_nodes,), -1, dtype=torch.long)
+
+	if method == 'species':
+		species = graph.node_species.view(-1)
+		order = torch.sort(species, stable=True)[1]
+		_, counts = torch.unique_consecutive(species[order], return_counts=True)
+
+		# give each species at least one partition
+		part_counts = (counts.double() / num_nodes * num_parts).round().clamp(min=1).long()
+		start, first_part = 0, 0
+		for count, parts in zip(counts.tolist(), part_counts.tolist()):
+			nodes = order[start:start + count]
+			nodes = nodes[torch.randperm(count, generator=generator)]
+			first_part = grow_partitions(csr, partition, nodes, -(-count // parts), first_part)
+			start += count
+
+	elif method == 'bfs':
+		node_order = torch.randperm(num_nodes, generator=generator)
+		grow_partitions(csr, partition, node_order, -(-num_nodes // num_parts))
+
+	else:
+		raise Exception('partition_graph(): method "' + method + '" not recognised')
+
+	return partition
+
+
+class ClusterLoader():
+	'''
+	Iterates over the induced subgraphs of a few random partitions at a time, giving large dense batches and far fewer
+	sampler calls per epoch than neighbour sampling. Target nodes are the input nodes inside the sampled partitions, or
+	with observed given only those whose labels are masked, the input nodes with observed labels stay in the batch as
+	context and their labels are set in batch.train_masked_y.
+	params:
+		- graph: graph to load batches from
+		- csr: CSR adjacency of the graph
+		- partition: [num_nodes] tensor of partition indexes, see partition_graph
+		- input_nodes: nodes which can be used as targets, e.g. split_idx['train']
+		- parts_per_batch: number of partitions combined into each batch
+		- shuffle: whether to randomise which partitions are combined each epoch
+		- transform (optional): function applied to every batch
+		- observed (optional): function returning a boolean tensor of whether the labels of each of a tensor of nodes are
+		  observed, e.g. data.LabelMask.lookup, called once per batch
+	'''
+	def __init__(self, graph, csr, partition, input_nodes, parts_per_batch=4, shuffle=True, transform=None, observed=None):
+		self.graph = graph
+		self.transform = transform
+		self.observed = observed
+		self.csr = csr
+		self.parts_per_batch = parts_per_batch
+		self.shuffle = shuffle
+		self.num_parts = int(partition.max()) + 1
+
+		self.is_input = torch.zeros(graph.num_nodes, dtype=torch.bool)
+		self.is_input[input_nodes] = True
+
+		# group nodes by partition
+		order = torch.argsort(partition, stable=True)
+		self.part_nodes = torch.split(order, torch.bincount(partition, minlength=self.num_parts).tolist())
+
+		self.local = torch.full((graph.num_nodes,), -1, dtype=torch.long)
+
+	def __len__(self):
+		return -(-self.num_parts // self.parts_per_batch)
+
+	def __iter__(self):
+		parts = torch.randperm(self.num_parts) if self.shuffle else torch.arange(self.num_parts)
+
+		for i in range(0, self.num_parts, self.parts_per_batch):
+			nodes = torch.cat([self.part_nodes[p] for p in parts[i:i + self.parts_per_batch].tolist()])
+
+			# target nodes come first, input nodes with observed labels are context
+			is_target = self.is_input[nodes]
+			if self.observed is not None:
+				observed = self.observed(nodes)
+				is_target &= ~observed
+				observed = torch.cat([observed[is_target], observed[~is_target]])
+			n_id = torch.cat([nodes[is_target], nodes[~is_target]])
+			batch_size = int(is_target.sum())
+
+			if batch_size == 0:
+				continue
+
+			edge_index, e_id = induced_subgraph(self.csr, n_id, self.local)
+			batch = collate(self.graph, n_id, edge_index, e_id, batch_size)
+			if self.observed is not None:
+				batch.train_masked_y = observed.unsqueeze(-1).to(torch.float) * batch.y
+			yield self.transform(batch) if self.transform else batch
+
+
+class NeighbourSampler():
+	'''
+	One-hop neighbour sampler over a CSR adjacency, sampling fanout incoming neighbours of each target node with
+	replacement. Random offsets are generated for a whole batch at once and node and edge attributes are gathered into
+	preallocated buffers, which are reused every num_buffers batches, so a batch must be consumed before then.
+	params:
+		- graph: graph to load batches from
+		- csr: CSR adjacency of the graph
+		- input_nodes: target nodes, e.g. split_idx['train']
+		- fanout: number of neighbours sampled per node
+		- batch_size: number of target nodes per batch
+		- shuffle: whether to shuffle the target nodes each epoch
+		- seed: seed of the generator used for sampling
+		- num_buffers: number of sets of output buffers to rotate through
+		- transform (optional): function applied to every batch, e.g. a data.LabelMask
+	'''
+	def __init__(self, graph, csr, input_nodes, fanout, batch_size, shuffle=True, seed=0, num_buffers=2, transform=None):
+		self.graph = graph
+		self.transform = transform
+		self.csr = csr
+		self.input_nodes = input_nodes
+		self.fanout = fanout
+		self.batch_size = batch_size
+		self.shuffle = shuffle
+		self.generator = torch.Generator().manual_seed(seed)
+		self.num_buffers = num_buffers
+		self.buffers = [None] * num_buffers
+		self.next_buffer = 0
+		self.edge_layouts = {}
+
+	def __len__(self):
+		return -(-self.input_nodes.numel() // self.batch_size)
+
+	def edge_layout(self, batch_size):
+		'''
+		returns:
+			edge_index shared by every batch with batch_size targets, sampled edge j of target i comes from node
+			batch_size + i * fanout + j
+		'''
+		if batch_size not in self.edge_layouts:
+			num_edges = batch_size * self.fanout
+			self.edge_layouts[batch_size] = torch.stack([torch.arange(batch_size, batch_size + num_edges), torch.arange(batch_size).repeat_interleave(self.fanout)])
+		return self.edge_layouts[batch_size]
+
+	def allocate(self):
+		'''
+		returns:
+			Dictionary of output buffers for one full batch
+		'''
+		num_nodes = self.batch_size * (self.fanout + 1)
+		num_edges = self.batch_size * self.fanout
+
+		buffers = {
+			'offsets': torch.empty(self.batch_size, self.fanout),
+			'pos': torch.empty(self.batch_size, self.fanout, dtype=torch.long),
+			'n_id': torch.empty(num_nodes, dtype=torch.long),
+			'e_id': torch.empty(num_edges, dtype=torch.long),
+			'edge_attr': torch.empty(num_edges, self.graph.edge_attr.size(-1), dtype=self.graph.edge_attr.dtype),
+		}
+		for key in [k for k in NODE_KEYS if k in self.graph]:
+			buffers[key] = torch.empty((num_nodes,) + self.graph[key].shape[1:], dtype=self.graph[key].dtype)
+		return buffers
+
+	def current_buffers(self):
+		'''
+		returns:
+			the set of output buffers the next batch is gathered into, allocated on first use
+		'''
+		if self.buffers[self.next_buffer] is None:
+			self.buffers[self.next_buffer] = self.allocate()
+		return self.buffers[self.next_buffer]
+
+	def sample(self, seeds):
+		'''
+		sample a batch for a set of target nodes
+		params:
+			- seeds: tensor of at most batch_size target node indexes
+		returns:
+			Data object of the batch, backed by the sampler's buffers
+		'''
+		start = self.csr.indptr[seeds]
+		deg = self.csr.indptr[seeds + 1] - start
+
+		# nodes without neighbours need padding, which sample_neighbours handles
+		if not bool(deg.gt(0).all()):
+			return self.gather(seeds, sample_neighbours(self.csr, seeds, self.fanout, generator=self.generator))
+
+		# random offset into each target's neighbour slice
+		buf = self.current_buffers()
+		offsets = torch.rand(seeds.numel(), self.fanout, generator=self.generator, out=buf['offsets'][:seeds.numel()])
+		offsets.mul_(deg.unsqueeze(-1))
+		pos = buf['pos'][:seeds.numel()]
+		pos.copy_(offsets).add_(start.unsqueeze(-1))
+
+		return self.gather(seeds, pos)
+
+	def gather(self, seeds, pos):
+		'''
+		gather a batch of target nodes and sampled edges into the next set of output buffers
+		params:
+			- seeds: tensor of at most batch_size target node indexes
+			- pos: [num_seeds, fanout] tensor of CSR positions of the sampled edges, -1 for padding
+		returns:
+			Data object of the batch, backed by the sampler's buffers unless it contains padding
+		'''
+		pos = pos.view(-1)
+		if bool(pos.lt(0).any()):
+			return one_hop_batch(self.graph, self.csr, seeds, pos.view(seeds.numel(), -1))
+
+		buf = self.current_buffers()
+		self.next_buffer = (self.next_buffer + 1) % self.num_buffers
+		batch_size = seeds.numel()
+		num_nodes = batch_size * (self.fanout + 1)
+		num_edges = batch_size * self.fanout
+
+		n_id = buf['n_id'][:num_nodes]
+		n_id[:batch_size] = seeds
+		torch.index_select(self.csr.indices, 0, pos, out=n_id[batch_size:])
+
+		e_id = buf['e_id'][:num_edges]
+		if self.csr.perm is None:
+			e_id.copy_(pos)
+		else:
+			torch.index_select(self.csr.perm, 0, pos, out=e_id)
+
+		batch = Data(
+				edge_index=self.edge_layout(batch_size),
+				edge_attr=torch.index_select(self.graph.edge_attr, 0, e_id, out=buf['edge_attr'][:num_edges]),
+				n_id=n_id,
+				e_id=e_id,
+				num_nodes=num_nodes,
+			)
+		for key in [k for k in NODE_KEYS if k in self.graph]:
+			batch[key] = torch.index_select(self.graph[key], 0, n_id, out=buf[key][:num_nodes])
+		batch.batch_size = batch_size
+
+		if 'y_packed' in batch:
+			unpack_labels(batch)
+
+		return batch
+
+	def __iter__(self):
+		nodes = self.input_nodes[torch.randperm(self.input_nodes.numel(), generator=self.generator)] if self.shuffle else self.input_nodes
+
+		for i in range(0, nodes.numel(), self.batch_size):
+			batch = self.sample(nodes[i:i + self.batch_size])
+			yield self.transform(batch) if self.transform else batch
+
+
+class NeighbourTableLoader(NeighbourSampler):
+	'''
+	Iterates over batches of input nodes whose neighbours come from a precomputed [num_input_nodes, fanout] table of sampled
+	edges, so batches are built by index gathering alone (into the buffers of NeighbourSampler). The table is resampled
+	every refresh epochs, which makes epochs fast and reproducible between refreshes.
+	params:
+		- graph: graph to load batches from
+		- csr: CSR adjacency of the graph
+		- input_nodes: target nodes, e.g. split_idx['train']
+		- fanout: number of neighbours sampled per node
+		- batch_size: number of target nodes per batch
+		- shuffle: whether to shuffle the target nodes each epoch
+		- refresh: number of epochs between resampling the table, 0 samples it once
+		- seed: seed of the generator used to sample the table
+		- num_buffers: number of sets of output buffers to rotate through
+		- transform (optional): function applied to every batch, e.g. a data.LabelMask
+	'''
+	def __init__(self, graph, csr, input_nodes, fanout, batch_size, shuffle=True, refresh=1, seed=0, num_buffers=2, transform=None):
+		super(NeighbourTableLoader, self).__init__(graph, csr, input_nodes, fanout, batch_size, shuffle=shuffle, seed=seed, num_buffers=num_buffers, transform=transform)
+		self.refresh = refresh
+		self.epoch = 0
+		self.table = None
+
+	def resample(self):
+		self.table = sample_neighbours(self.csr, self.input_nodes, self.fanout, generator=self.generator)
+
+	def __iter__(self):
+		if self.table is None or (self.refresh > 0 and self.epoch % self.refresh == 0):
+			self.resample()
+		self.epoch += 1
+
+		rows = torch.randperm(self.input_nodes.numel(), generator=self.generator) if self.shuffle else torch.arange(self.input_nodes.numel())
+
+		for i in range(0, rows.numel(), self.batch_size):
+			batch_rows = rows[i:i + self.batch_size]
+			batch = self.gather(self.input_nodes[batch_rows], self.table[batch_rows])
+			yield self.transform(batch) if self.transform else batch
+
+
+class FullNeighbourLoader():
+	'''
+	Iterates over target nodes in order with all of their incoming edges rather than a sample of them, so that inference is
+	exact and deterministic. Targets are chunked so that no batch holds more than max_edges edges.
+	params:
+		- graph: graph to load batches from
+		- csr: CSR adjacency of the graph
+		- input_nodes: target nodes, e.g. split_idx['valid']
+		- max_edges: maximum number of edges in a batch
+	'''
+	def __init__(self, graph, csr, input_nodes, max_edges=2**20):
+		self.graph = graph
+		self.csr = csr
+		self.chunks = chunk_by_edges(csr, input_nodes, max_edges)
+
+	def __len__(self):
+		return len(self.chunks)
+
+	def __iter__(self):
+		for seeds in self.chunks:
+			yield full_neighbour_batch(self.graph, self.csr, seeds)
+
+
+class PrefetchLoader():
+	'''
+	Wraps a loader with a background thread which keeps up to depth batches sampled, collated (and optionally moved to a
+	device) ahead of the consumer, so sampling overlaps with the model step. Loaders that reuse output buffers
+	(NeighbourSampler, NeighbourTableLoader) need at least depth + 2 of them.
+	params:
+		- loader: loader to prefetch batches from
+		- depth: maximum number of batches waiting in the queue
+		- device (optional): device to move batches to in the background thread
+	'''
+	def __init__(self, loader, depth=4, device=None):
+		if getattr(loader, 'num_buffers', depth + 2) < depth + 2:
+			raise Exception('PrefetchLoader: loader must have at least depth + 2 output buffers')
+
+		self.loader = loader
+		self.depth = depth
+		self.device = device
+		self.thread = None
+		self.stop = threading.Event()
+		self.reset_stats()
+
+	def __len__(self):
+		return len(self.loader)
+
+	def reset_stats(self):
+		self.num_batches = 0
+		self.total_queue_depth = 0
+		self.consumer_stall_time = 0.
+		self.producer_stall_time = 0.
+
+	def stats(self):
+		'''
+		returns:
+			Dictionary of pipeline statistics for the current epoch: mean number of batches ready when the consumer asked
+			for one, and total seconds the consumer waited on the sampler and the sampler waited on a full queue
+		'''
+		return {
+			'batches': self.num_batches,
+			'mean_queue_depth': self.total_queue_depth / max(self.num_batches, 1),
+			'consumer_stall_time': self.consumer_stall_time,
+			'producer_stall_time': self.producer_stall_time,
+		}
+
+	def put(self, batches, item):
+		'''
+		put an item on the queue, giving up if the pipeline is stopped while the queue is full
+		returns:
+			False if the pipeline was stopped before the item was queued
+		'''
+		while not self.stop.is_set():
+			try:
+				batches.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				continue
+		return False
+
+	def produce(self, batches):
+		try:
+			for batch in self.loader:
+				if self.device is not None:
+					batch = batch.to(self.device)
+
+				start = time.perf_counter()
+				queued = self.put(batches, batch)
+				self.producer_stall_time += time.perf_counter() - start
+
+				if not queued:
+					return
+			self.put(batches, None)
+		except Exception as e:
+			self.put(batches, e)
+
+	def shutdown(self):
+		'''
+		stop the background thread of an unfinished epoch
+		'''
+		if self.thread is not None:
+			self.stop.set()
+			self.thread.join()
+			self.thread = None
+			self.stop.clear()
+
+	def __iter__(self):
+		self.shutdown()
+		self.reset_stats()
+
+		batches = queue.Queue(maxsize=self.depth)
+		self.thread = threading.Thread(target=self.produce, args=(batches,), daemon=True)
+		self.thread.start()
+
+		# an epoch left early (an exception in the model step, or a break) stops its thread when the generator is closed
+		try:
+			while True:
+				self.total_queue_depth += batches.qsize()
+
+				start = time.perf_counter()
+				batch = batches.get()
+				self.consumer_stall_time += time.perf_counter() - start
+
+				if batch is None:
+					break
+				if isinstance(batch, Exception):
+					raise batch
+
+				self.num_batches += 1
+				yield batch
+		finally:
+			self.shutdown()
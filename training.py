@@ -4,20 +4,54 @@ from ogb.nodeproppred import Evaluator
 from logger import Logger
 import numpy as np 
 import json
+from torch_geometric.data import Data
 from torch_geometric.loader import DataLoader, NeighborLoader
 import torch_geometric.transforms as T
-from torch_scatter import scatter
 import config
+from cache import PreprocessCache
+from inference import LayerwiseInference, PredictionEngine
+from sampler import ClusterLoader, FullNeighbourLoader, NeighbourSampler, NeighbourTableLoader, PrefetchLoader, partition_graph
+from data import CSR, LabelMask, pack_labels, unpack_labels, unpack_bits, to_csr, is_sorted_by_target, quantise_edge_attr, aggregate_edge_attr
+
+
+def bf16_supported(device=config.device):
+	'''
+	returns:
+		True if device has native bfloat16 support for autocast, on CPUs this needs AVX512-BF16 or AMX
+	'''
+	device = torch.device(device)
+	if device.type == 'cuda':
+		return torch.cuda.is_bf16_supported()
+	return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
 
 class GraphTrainer():
 	'''
 	Class for full batch graph training 
 	'''
-	def __init__(self, graph, split_idx, train_batch_size=64, evaluate_batch_size=None, label_mask_p=0.5, sampler_num_neighbours=597):
+	def __init__(self, graph, split_idx, train_batch_size=64, evaluate_batch_size=None, label_mask_p=0.5, sampler_num_neighbours=597, seed=0, cache_dir=None, edge_attr_dtype=None, node_features=('mean',), sampler='neighbour', num_parts=64, parts_per_batch=4, partition_method='bfs', table_refresh=1, prefetch=0, evaluate_max_edges=2**20, label_remask=None, packed_labels=False):
 		'''
 		params:
 			- graph dataset
 			- dictionary for storing the sample splits (train | valid | test) indexes
+			- seed: seed of the generator used to mask labels
+			- cache_dir (optional): directory of the on-disk preprocessing cache, preprocessed arrays are memory-mapped from here when available
+			- edge_attr_dtype (optional): compact storage type for edge features (torch.uint8 or torch.float16), applied after node features are computed
+			- node_features: reductions of the incoming edge features concatenated into node features, any of 'sum', 'mean', 'max', 'min', 'std'
+			- sampler: how batches are sampled, 'neighbour' samples sampler_num_neighbours neighbours of train_batch_size train
+			  nodes with NeighborLoader, 'csr' does the same with the vectorised sampler.NeighbourSampler, 'table' gathers them
+			  from a precomputed neighbour table resampled every table_refresh epochs (and sampled once for validation),
+			  'cluster' trains on the induced subgraphs of parts_per_batch graph partitions at a time, with the train nodes
+			  whose labels are masked as targets and the rest as observed context
+			- num_parts: number of partitions in cluster mode, the partition assignment is cached to disk with cache_dir
+			- parts_per_batch: number of partitions in each batch in cluster mode
+			- partition_method: how to partition the graph in cluster mode, 'bfs' or 'species' (see sampler.partition_graph)
+			- table_refresh: number of epochs between resampling the training neighbour table in table mode
+			- prefetch: number of batches to sample ahead of the model in a background thread, 0 disables prefetching
+			- evaluate_max_edges: maximum number of edges per batch in full graph evaluation
+			- label_remask (optional): redraw which training labels are observed every 'epoch' or every 'batch' rather than
+			  masking them once, the mask is stored as a bitmask and applied to sampled nodes only (see data.LabelMask)
+			- packed_labels: store labels as bits with a flag byte per node in place of y, train_masked_y and eval_masked_y,
+			  they are unpacked for the nodes of each batch (see data.pack_labels)
 		'''
 #		graph.num_nodes = torch.tensor(graph.num_nodes)
 		self.graph = graph#.to(config.device)
@@ -25,15 +59,22 @@ class GraphTrainer():
 		self.evaluator = Evaluator(name='ogbn-proteins')
 		self.sampler_num_neighbours = sampler_num_neighbours
 		self.label_mask_p = label_mask_p
-
-		# aggregate edge features using mean
-		x = scatter(graph.edge_attr, graph.edge_index[0], dim=0, dim_size=graph.num_nodes, reduce='mean')
-		self.graph.x = x
-		
-		# mask labels
-		self.graph.train_masked_y, _ = self.mask_labels(label_mask_p)
-		self.graph.eval_masked_y, _ = self.mask_labels(0, mask_eval=True)
-
+		self.seed = seed
+		self.node_features = tuple(node_features)
+		self.generator = torch.Generator().manual_seed(seed)
+		self.sampler = sampler
+		self.label_remask = label_remask
+		self.packed_labels = packed_labels
+		self.num_labels = graph.y.size(-1)
+		self.cache = PreprocessCache(cache_dir, label_mask_p=label_mask_p, seed=seed) if cache_dir else None
+		self.csr = None
+
+		# compute node features, masked labels and CSR adjacency, or map them in from the cache
+		self.preprocess()
+
+		# store edge features compactly, they are dequantised inside the models' edge projections
+		if edge_attr_dtype is not None:
+			self.graph.edge_attr = quantise_edge_attr(self.graph.edge_attr, edge_attr_dtype)
 		
 
 #		valid_labels = {}
@@ -63,54 +104,239 @@ class GraphTrainer():
 
 		self.train_batch_size = train_batch_size
 		self.evaluate_batch_size = evaluate_batch_size if evaluate_batch_size else train_batch_size
+
+		# edges loaded with get_graph_data(mmap=True) are already in CSR order, which lets the sampler skip its own sort
+		is_sorted = self.csr is not None and self.csr.perm is None
+
+		# NeighborLoader batches are not collated by sampler.collate, so packed labels are unpacked in its transform
+		unpack = [unpack_labels] if packed_labels else []
+		remask = [self.label_mask] if self.label_mask is not None else []
 		
 		# set feature variables
-		self.train_loader = NeighborLoader(
-								self.graph,
-								num_neighbors=[self.sampler_num_neighbours],
-								batch_size=self.train_batch_size,
-								directed=True,
-								replace=True,
-								shuffle=True,
-								input_nodes=split_idx['train'],
-								#transform=self.transforms,
-		)
+		if sampler == 'neighbour':
+			self.train_loader = NeighborLoader(
+									self.graph,
+									num_neighbors=[self.sampler_num_neighbours],
+									batch_size=self.train_batch_size,
+									directed=True,
+									replace=True,
+									shuffle=True,
+									input_nodes=split_idx['train'],
+									is_sorted=is_sorted,
+									transform=T.Compose(unpack + remask) if unpack + remask else None,
+			)
+		elif sampler == 'csr':
+			self.train_loader = NeighbourSampler(
+									self.graph,
+									self.get_csr(),
+									input_nodes=split_idx['train'],
+									fanout=self.sampler_num_neighbours,
+									batch_size=self.train_batch_size,
+									shuffle=True,
+									seed=seed,
+									num_buffers=prefetch + 2,
+									transform=self.label_mask,
+			)
+		elif sampler == 'table':
+			self.train_loader = NeighbourTableLoader(
+									self.graph,
+									self.get_csr(),
+									input_nodes=split_idx['train'],
+									fanout=self.sampler_num_neighbours,
+									batch_size=self.train_batch_size,
+									shuffle=True,
+									refresh=table_refresh,
+									seed=seed,
+									num_buffers=prefetch + 2,
+									transform=self.label_mask,
+			)
+		elif sampler == 'cluster':
+			self.train_loader = ClusterLoader(
+									self.graph,
+									self.get_csr(),
+									self.get_partition(num_parts, partition_method),
+									input_nodes=split_idx['train'],
+									parts_per_batch=parts_per_batch,
+									shuffle=True,
+									observed=self.label_mask.lookup if self.label_mask is not None else self.train_observed.__getitem__,
+			)
+		else:
+			raise Exception('GraphTrainer: sampler "' + sampler + '" not recognised')
 		
-		self.valid_loader = NeighborLoader(
-								self.graph,
-								num_neighbors=[self.sampler_num_neighbours],
-								batch_size=self.evaluate_batch_size,
-								replace=True,
-								directed=True,
-								shuffle=False,
-								input_nodes=split_idx['valid'],
-								#transform=self.transforms,
-		)
+		if sampler == 'table':
+			self.valid_loader = NeighbourTableLoader(
+									self.graph,
+									self.get_csr(),
+									input_nodes=split_idx['valid'],
+									fanout=self.sampler_num_neighbours,
+									batch_size=self.evaluate_batch_size,
+									shuffle=False,
+									refresh=0,
+									seed=seed,
+									num_buffers=prefetch + 2,
+			)
+		elif sampler == 'csr':
+			self.valid_loader = NeighbourSampler(
+									self.graph,
+									self.get_csr(),
+									input_nodes=split_idx['valid'],
+									fanout=self.sampler_num_neighbours,
+									batch_size=self.evaluate_batch_size,
+									shuffle=False,
+									seed=seed,
+									num_buffers=prefetch + 2,
+			)
+		else:
+			self.valid_loader = NeighborLoader(
+									self.graph,
+									num_neighbors=[self.sampler_num_neighbours],
+									batch_size=self.evaluate_batch_size,
+									replace=True,
+									directed=True,
+									shuffle=False,
+									input_nodes=split_idx['valid'],
+									is_sorted=is_sorted,
+									transform=T.Compose(unpack) if unpack else None,
+			)
 	
+		# full neighbourhood loaders for exact evaluation, built on first use
+		self.evaluate_max_edges = evaluate_max_edges
+		self.full_loaders = {}
+
+		# sample batches in the background while the model runs
+		self.prefetch = prefetch
+		if prefetch > 0:
+			self.train_loader = PrefetchLoader(self.train_loader, depth=prefetch, device=config.device)
+			self.valid_loader = PrefetchLoader(self.valid_loader, depth=prefetch, device=config.device)
+
+	def preprocess(self):
+		'''
+		compute node features and masked labels, if the trainer has a cache directory they are memory-mapped from it
+		instead when present and saved to it (along with the CSR adjacency) when not
+		'''
+		cache = self.cache
+
+		graph_arrays = (cache.load_graph() if cache else None) or {}
+
+		# node features are cached per set of reductions
+		x_name = 'x_' + '_'.join(self.node_features)
+		if x_name not in graph_arrays:
+			# aggregate edge features onto their source nodes, streamed in chunks
+			graph_arrays[x_name] = aggregate_edge_attr(self.graph.edge_attr, self.graph.edge_index[0], self.graph.num_nodes, reduce=self.node_features)
+			if cache:
+				cache.save_graph({x_name: graph_arrays[x_name]})
+
+		if cache and 'indptr' not in graph_arrays:
+			csr = self.get_csr()
+			csr_arrays = {'indptr': csr.indptr, 'indices': csr.indices}
+			if csr.perm is not None:
+				csr_arrays['perm'] = csr.perm
+			cache.save_graph(csr_arrays)
+
+		self.graph.x = graph_arrays[x_name]
+		if 'indptr' in graph_arrays:
+			# the cached permutation only applies if the graph is in its original edge order, e.g. not loaded with mmap=True
+			if is_sorted_by_target(self.graph.edge_index):
+				self.csr = CSR(graph_arrays['indptr'], self.graph.edge_index[0], None)
+			elif 'perm' in graph_arrays:
+				self.csr = CSR(graph_arrays['indptr'], graph_arrays['indices'], graph_arrays['perm'])
+
+		label_arrays = (cache.load_labels() if cache else None) or {}
+		if 'train_observed' not in label_arrays:
+			# mask labels
+			label_arrays = {
+				'train_observed': self.observe_labels(self.label_mask_p),
+				'eval_masked_y': self.mask_labels(0, mask_eval=True)[0],
+			}
+			if cache:
+				cache.save_labels(label_arrays)
+
+		self.graph.eval_masked_y = label_arrays['eval_masked_y']
+		self.train_observed = label_arrays['train_observed']
+
+		if self.label_remask:
+			# training labels are masked as batches are collated instead, so no graph sized copy of them is made
+			self.label_mask = LabelMask(self.graph.num_nodes, self.split_idx['train'], self.label_mask_p, mode=self.label_remask, seed=self.seed)
+		else:
+			self.label_mask = None
+			if 'train_masked_y' not in label_arrays:
+				label_arrays['train_masked_y'] = self.graph.y * self.train_observed.unsqueeze(-1).to(torch.float)
+				if cache:
+					cache.save_labels({'train_masked_y': label_arrays['train_masked_y']})
+			self.graph.train_masked_y = label_arrays['train_masked_y']
+
+		if self.packed_labels:
+			# only training labels are observed in evaluation
+			is_train = torch.zeros(self.graph.num_nodes, dtype=torch.bool)
+			is_train[self.split_idx['train']] = True
+
+			self.graph.y_packed, self.graph.label_flags = pack_labels(self.graph.y, self.train_observed, is_train)
+			for key in ['y', 'train_masked_y', 'eval_masked_y']:
+				if key in self.graph:
+					del self.graph[key]
+
+	def get_csr(self):
+		'''
+		returns:
+			CSR adjacency of the graph grouped by target node, built on first use
+		'''
+		if self.csr is None:
+			self.csr = to_csr(self.graph.edge_index, self.graph.num_nodes)
+		return self.csr
+
+	def get_partition(self, num_parts, method='bfs'):
+		'''
+		partition the graph for cluster training, loading the assignment from the cache when available
+		returns:
+			[num_nodes] tensor of partition indexes
+		'''
+		name = 'partition_{0}_{1}_s{2}'.format(method, num_parts, self.seed)
+		graph_arrays = (self.cache.load_graph() if self.cache else None) or {}
+
+		if name in graph_arrays:
+			return graph_arrays[name]
+
+		partition = partition_graph(self.graph, self.get_csr(), num_parts, method=method, seed=self.seed)
+		if self.cache:
+			self.cache.save_graph({name: partition})
+		return partition
+
+	def get_full_loader(self, sample_set):
+		'''
+		returns:
+			FullNeighbourLoader over a sample set (train | valid | test), built on first use
+		'''
+		if sample_set not in self.full_loaders:
+			self.full_loaders[sample_set] = FullNeighbourLoader(self.graph, self.get_csr(), self.split_idx[sample_set], max_edges=self.evaluate_max_edges)
+		return self.full_loaders[sample_set]
+
+	def labels(self, nodes):
+		'''
+		returns:
+			[num_nodes, num_labels] tensor of the labels of a set of nodes, unpacked if the labels are stored packed
+		'''
+		if self.packed_labels:
+			return unpack_bits(self.graph.y_packed[nodes], self.num_labels, dtype=torch.long)
+		return self.graph.y[nodes]
+
+	def observe_labels(self, label_mask_p):
+		'''
+		randomly select training points to keep (True) and remove (False), ALL valid and test labels are removed
+		returns:
+			[num_nodes] boolean tensor of nodes whose labels are observed
+		'''
+		observed = torch.zeros(self.graph.num_nodes, dtype=torch.bool)
+		observed[self.split_idx['train']] = torch.rand(self.split_idx['train'].numel(), generator=self.generator).ge(label_mask_p)
+		return observed
+
 	def mask_labels(self, label_mask_p, mask_eval=True):
 		if not mask_eval:
 			raise NotImplemented('unmasked valid and test labels is not implmented')
 
-		# randomly select training points to keep (1) and remove(0)
-		train_labels = self.graph.y[self.split_idx['train']]
-		train_mask = torch.rand(train_labels.shape[0]).ge(label_mask_p).unsqueeze(-1)
-		
-		# remove ALL valid and test labels
-		valid_test_mask = torch.zeros(len(self.split_idx['valid']) + len(self.split_idx['test']), 1)
-
-		# create mask and inverted mask
-		mask = torch.cat((train_mask, valid_test_mask), 0)
-		inverted_mask = torch.ones_like(mask) - mask
+		mask = self.observe_labels(label_mask_p).unsqueeze(-1).to(torch.float)
 
 		# only keep labels that mask == 1 at
-		# observed_y = (self.graph.y + torch.ones_like(self.graph.y)) * mask
-		observed_y = self.graph.y * mask
-
-		# replace all masked values with tensor of 2's to allow model to learn mask representation
-		masked_y = (torch.ones_like(self.graph.y) * 2) * inverted_mask
-
-		# combine masks
-		known_y = observed_y #+ masked_y
+		known_y = self.graph.y * mask
 		
 		return known_y, mask
 
@@ -135,7 +361,7 @@ class GraphTrainer():
 			total_params+=param
 		return total_params
 
-	def train(self, model, criterion, num_runs=1, num_epochs=10, lr=1e-3, use_scheduler=True, save_log=False, valid_step=5):
+	def train(self, model, criterion, num_runs=1, num_epochs=10, lr=1e-3, use_scheduler=True, save_log=False, valid_step=5, full_graph_eval=False, compile_model=False, mixed_precision=False, edge_cache=None):
 		'''
 		train a model in full batch graph mode
 		params:
@@ -147,17 +373,46 @@ class GraphTrainer():
 			- use_scheduler: whether to incremently decrease learning rate or not
 			- save_log: if model
  logs should be saved to file
+			- full_graph_eval: validate on every incoming edge of each node rather than a sample of them
+			- compile_model: run the model through torch.compile, the first batches (and the first evaluation) are slower
+			  while it compiles. model itself is left uncompiled
+			- mixed_precision: run the model's forward and backward passes under bfloat16 autocast, with float32 weights,
+			  loss and metrics. Ignored (with a message) on devices without bfloat16 support
+			- edge_cache (optional): models.transformers.EdgeProjectionCache to share between the edge projections of an
+			  AttentionGNN created with edge_space=False (see AttentionGNN.set_edge_cache). It stays attached to the model,
+			  so later evaluate and predict calls over the same batches (full graph evaluation, or the fixed validation
+			  table of the 'table' sampler) reuse the projections while the weights are unchanged
 		returns:
 			Logger object with logs of the total training cycle
 		'''
 		torch.manual_seed(0)
+
+		# emulated bfloat16 is slower than float32, so mixed precision is only used with hardware support
+		if mixed_precision and not bf16_supported():
+			print('bfloat16 is not supported on {0}, training in float32'.format(config.device))
+			mixed_precision = False
+
 		# store model and training information and save it in the logger
 		info = model.param_dict
 		info['num_runs'], info['batch_size'], info['sampler_num_neighbours'], info['lr'], info['num_epochs'], info['use_scheduler'], info['trainable_parameters'] = num_runs, self.train_batch_size, self.sampler_num_neighbours, lr, num_epochs, use_scheduler, self.count_parameters(model)
+		info['sampler'], info['label_remask'], info['compile'], info['mixed_precision'] = self.sampler, self.label_remask, compile_model, mixed_precision
+		info['edge_cache'] = edge_cache is not None
 		print('Training config: {0}'.format(info))
 		logger = Logger(info=model.param_dict)
 		model.to(config.device)
 
+		if edge_cache is not None:
+			if not hasattr(model, 'set_edge_cache'):
+				raise Exception('trainer.train(): model "' + model.param_dict['model_type'] + '" does not support edge projection caching')
+			model.set_edge_cache(edge_cache)
+
+		# models without trainable parameters (e.g. LabelPropagation) are fitted once rather than trained for epochs
+		if hasattr(model, 'fit'):
+			return self.fit(model, criterion, logger, num_runs=num_runs, save_log=save_log)
+
+		# the compiled wrapper shares the model's parameters, so model is trained without being compiled itself
+		forward_model = torch.compile(model) if compile_model else model
+
 		# perform a new training experiement for each run, reseting the model parameters each time
 		for run in range(1, num_runs+1):
 			print('R' + str(run))
@@ -175,15 +430,20 @@ class GraphTrainer():
 			epoch_bar = tqdm(range(1, num_epochs+1))
 			for epoch in epoch_bar:
 				# perform a train pass
-				train_loss, train_roc = self.train_pass(model, optimizer, criterion)
+				train_loss, train_roc = self.train_pass(forward_model, optimizer, criterion, mixed_precision=mixed_precision)
 				current_lr = optimizer.param_groups[0]['lr']
 
 				results_dict = {}
 				results_dict['run'], results_dict['epoch'], results_dict['lr'], results_dict['train_loss'], results_dict['train_roc'], results_dict['valid_loss'], results_dict['valid_roc'] = run, epoch, current_lr, train_loss, train_roc, valid_loss, valid_roc
 
+				# record how long the model waited on the sampler
+				if self.prefetch > 0:
+					pipeline_stats = self.train_loader.stats()
+					results_dict['train_stall_time'], results_dict['train_queue_depth'] = pipeline_stats['consumer_stall_time'], pipeline_stats['mean_queue_depth']
+
 				if epoch % valid_step == 0 or epoch == 1:
 					# construct a results dictionary to store training parameters and model performance metrics
-					valid_loss, valid_roc = self.evaluate(model, sample_set='valid', criterion=criterion)
+					valid_loss, valid_roc = self.evaluate(forward_model, sample_set='valid', criterion=criterion, full_graph=full_graph_eval, mixed_precision=mixed_precision)
 					results_dict['valid_loss'], results_dict['valid_roc'] = valid_loss, valid_roc
 				
 				logger.log(results_dict)
@@ -214,13 +474,45 @@ class GraphTrainer():
 		return logger
 
 
-	def train_pass(self, model, optimizer, criterion):
+	def fit(self, model, criterion, logger, num_runs=1, save_log=False):
+		'''
+		fit a model on the known training labels of the full graph and evaluate it, see train
+		params:
+			- model: model implementing fit(graph, csr, train_idx, train_y), e.g. LabelPropagation
+			- criterion: object to calculate loss between model predictions and targets
+			- logger: Logger to record the results in
+			- num_runs: number of times to fit the model
+			- save_log: if model logs should be saved to file
+		returns:
+			Logger object with logs of the fitted model
+		'''
+		for run in range(1, num_runs+1):
+			print('R' + str(run))
+			model.reset_parameters()
+			model.fit(self.graph, self.get_csr(), self.split_idx['train'], self.labels(self.split_idx['train']))
+
+			train_loss, train_roc = self.evaluate(model, sample_set='train', criterion=criterion)
+			valid_loss, valid_roc = self.evaluate(model, sample_set='valid', criterion=criterion)
+
+			results_dict = {}
+			results_dict['run'], results_dict['epoch'], results_dict['lr'], results_dict['train_loss'], results_dict['train_roc'], results_dict['valid_loss'], results_dict['valid_roc'] = run, 1, 0, train_loss, train_roc, valid_loss, valid_roc
+			logger.log(results_dict)
+
+			if save_log:
+				logger.save("logs/{0}_log.json".format(model.param_dict['model_type']))
+
+		logger.print()
+
+		return logger
+
+	def train_pass(self, model, optimizer, criterion, mixed_precision=False):
 		'''
 		pass full graph through model and update weights
 		params:
 			- model: PyTorch model to train
 			- optimizer: optimizer to use to update weights
 			- criterion: object to calculate loss between target and model output
+			- mixed_precision: run the model under bfloat16 autocast, see train
 		returns:
 			Float of loss of the model on the train set
 		'''
@@ -229,17 +521,23 @@ class GraphTrainer():
 		pred = []
 		gts = []
 
+		# observe a new set of training labels this epoch
+		if self.label_mask is not None and self.label_mask.mode == 'epoch':
+			self.label_mask.redraw()
+
 		for batch in self.train_loader:
 			optimizer.zero_grad()
 
 			# mask out all 'source' node labels to avoid label leakage
 			batch.train_masked_y[:batch.batch_size] = torch.ones_like(batch.train_masked_y[:batch.batch_size]) * 2
 
-			# calculate output
-			pred_y = model(batch.to(config.device))[:batch.batch_size]
+			# calculate output, the loss and metrics are computed in float32 under mixed precision
+			with torch.autocast(device_type=torch.device(config.device).type, dtype=torch.bfloat16, enabled=mixed_precision):
+				pred_y = model(batch.to(config.device))[:batch.batch_size]
+			pred_y = pred_y.float()
 
 			pred.append(pred_y.cpu())
-			gts.append(batch.y[:batch.batch_size])
+			gts.append(batch.y[:batch.batch_size].clone())
 
 			# update weights
 			loss = criterion(pred_y, batch.y[:batch.batch_size].to(torch.float))
@@ -259,39 +557,57 @@ class GraphTrainer():
 			
 		
 
-	def evaluate(self, model, sample_set='valid', criterion=torch.nn.BCEWithLogitsLoss(), save_path=None):
+	def evaluate(self, model, sample_set='valid', criterion=torch.nn.BCEWithLogitsLoss(), save_path=None, full_graph=False, mixed_precision=False):
 		'''
-		perform a evaluation of a model on validation set
+		perform a evaluation of a model on a sample set
 		params:
 			- model: model to evaluate
+			- sample_set: set of nodes to evaluate on (train | valid | test), only valid has a sampled loader so the train
+			  and test sets are always evaluated on the full graph
 			- criterion: object to calculate loss between target and model output
-			- save_path (optional): if provided the complete y_pred output will be stored at this file location
+			- save_path (optional): if provided the complete y_pred output will be stored at this file location, use
+			  predict to stream predictions for large sets to disk instead
+			- full_graph: use every incoming edge of each node, in chunks of at most evaluate_max_edges edges, rather than
+			  a sample of them, this makes the result exact and deterministic
+			- mixed_precision: run the model under bfloat16 autocast, see train
 		returns:
 			Dictionary object containing the results from test pass
 		'''
 		with torch.no_grad():
 			model.eval()
 
-			if sample_set == 'valid':
+			if sample_set not in ['train', 'valid', 'test']:
+				raise Exception('trainer.evaluate(): sample_set "' + sample_set + '" not recognited')
+
+			if hasattr(model, 'fit'):
+				# fitted models hold a prediction for every node, so the whole set is scored as one batch of node ids
+				nodes = self.split_idx[sample_set]
+				sample_loader = [Data(n_id=nodes, y=self.labels(nodes), batch_size=nodes.numel())]
+			elif sample_set == 'valid' and not full_graph:
 				sample_loader = self.valid_loader
 			else:
-				raise Exception('trainer.evaluate(): sample_set "' + sample_set + '" not recognited')
+				sample_loader = self.get_full_loader(sample_set)
 				
-			pred, loss, count = [], 0, 0
+			pred, gts, loss, count = [], [], 0, 0
 
 			for batch in sample_loader:
-				pred_y = model(batch.to(config.device))[:batch.batch_size]
-				loss += criterion(pred_y, batch.y[:batch.batch_size].to(torch.float)).item()
+				with torch.autocast(device_type=torch.device(config.device).type, dtype=torch.bfloat16, enabled=mixed_precision):
+					pred_y = model(batch.to(config.device))[:batch.batch_size]
+				pred_y = pred_y.float()
+
+				# weight by batch size so the loss does not depend on how the sample set is split into batches
+				loss += criterion(pred_y, batch.y[:batch.batch_size].to(torch.float)).item() * batch.batch_size
 				
 				pred.append(pred_y.cpu())
-				count += 1
+				gts.append(batch.y[:batch.batch_size].to('cpu', copy=True))
+				count += batch.batch_size
 
 			pred = torch.cat(pred, dim=0)
 
 			# loop over each sample set (train | valid | test) and calculate loss and ROC
 			loss = loss / count
 			roc = self.evaluator.eval({
-									'y_true': self.graph.y[self.split_idx[sample_set]],
+									'y_true': torch.cat(gts, dim=0),
 									'y_pred': pred,
 								})['rocauc']
 		
@@ -300,6 +616,40 @@ class GraphTrainer():
 
 		return loss, roc
 
+	def predict(self, model, out_path, sample_set='all', resume=True):
+		'''
+		stream full graph predictions for a sample set into a memory-mapped file, see inference.PredictionEngine
+		params:
+			- model: model to score nodes with
+			- out_path: .npy file to write the [num_nodes, 112] predictions to, row i holds the logits of node i
+			- sample_set: set of nodes to score (train | valid | test | all)
+			- resume: continue from the last completed chunk of an interrupted run of the same model and nodes
+		returns:
+			[num_nodes, 112] tensor memory-mapped from out_path
+		'''
+		if sample_set == 'all':
+			nodes = torch.arange(self.graph.num_nodes)
+		elif sample_set in ['train', 'valid', 'test']:
+			nodes = self.split_idx[sample_set]
+		else:
+			raise Exception('trainer.predict(): sample_set "' + sample_set + '" not recognited')
+
+		engine = PredictionEngine(self.graph, self.get_csr(), max_edges=self.evaluate_max_edges, device=config.device)
+		return engine.predict(model, nodes, out_path, out_dim=self.num_labels, resume=resume)
+
+	def predict_layerwise(self, model, cache_dir, reuse=False):
+		'''
+		full graph inference one layer at a time with cached intermediate embeddings, see inference.LayerwiseInference
+		params:
+			- model: GNN or AttentionGNN model to score nodes with
+			- cache_dir: directory to store the per layer embeddings in
+			- reuse: keep layers cached by a previous run with the same model weights, layers and evaluate_max_edges
+		returns:
+			[num_nodes, 112] tensor of predictions for every node, memory-mapped from cache_dir
+		'''
+		engine = LayerwiseInference(self.graph, self.get_csr(), cache_dir, max_edges=self.evaluate_max_edges, device=config.device)
+		return engine.run(model, reuse=reuse)
+
 	def hyperparam_search(
 			self,
 			model,